@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+# Synthetic song generator and benchmarks for shaketrackertool.
+#
+#   benchmark.py generate song.sht --format sht2 --instruments 8 --patterns 50
+#   benchmark.py run --output results.json [--compare previous.json]
+
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import shaketracker as stt
+
+#
+# - generator -
+#
+
+SIZES = {
+    'small': dict(instruments=4, patterns=16, width=2, rows=64, density=0.2),
+    'medium': dict(instruments=8, patterns=50, width=3, rows=64, density=0.3),
+    'large': dict(instruments=16, patterns=100, width=4, rows=128, density=0.4),
+}
+
+def random_row(rng):
+    note = rng.choice((stt.CLEAR, stt.OFF, rng.randrange(0, 128)))
+    vol = rng.choice((stt.CLEAR, rng.randrange(0, 65)))
+    command = rng.choice((stt.CLEAR, rng.randrange(1, 30)))
+    parameter = rng.choice((0, rng.randrange(0, 256)))
+    controller_set = rng.choice((stt.CLEAR, rng.randrange(0, 120)))
+    controller_value = rng.choice((0, rng.randrange(0, 128)))
+
+    return stt.Row(note, vol, command, parameter, controller_set, controller_value)
+
+def generate_song(instruments=4, patterns=16, width=2, rows=64, density=0.2, seed=0):
+    rng = random.Random(seed)
+
+    song = stt.Song()
+    song.name = f'Synthetic {seed}'
+    song.author = 'benchmark.py'
+    song.tempo = 150
+    song.speed = 4
+
+    row_counts = [rows] * patterns
+    if patterns > 1:
+        # a few odd lengths, including the 48 rows that 0.4.6 is picky about
+        for pattern_idx, row_count in zip(range(1, patterns, 3), (rows - 1, rows // 2 + 1, 1)):
+            row_counts[pattern_idx] = row_count
+        row_counts[-1] = 48
+    song.pattern_metrics = [stt.PatternMetrics(row_count, 16, 4) for row_count in row_counts]
+
+    song.order_list = [rng.randrange(patterns) if order_idx < patterns * 2 else None for order_idx in range(500)]
+
+    for instrument_idx in range(instruments):
+        instrument_width = rng.randint(1, width) if instrument_idx else width
+        song.instruments.append(stt.Instrument(f'Instrument {instrument_idx}', instrument_width, 0, 0, instrument_idx % 128, instrument_idx % 16, 2, 64, 127))
+
+        instrument_rows = []
+        for row_count in row_counts:
+            columns = []
+            for column_idx in range(instrument_width):
+                column = []
+                while len(column) < row_count:
+                    # runs of identical rows, so repeats get exercised too
+                    row = random_row(rng) if rng.random() < density else stt.EMPTY_ROW
+                    column.extend([row] * rng.choice((1, 1, 1, 2, 4, 16)))
+                columns.append(column[:row_count])
+            instrument_rows.append(columns)
+        song.rows.append(instrument_rows)
+
+    return song
+
+def row_to_sht2_values(row, rng):
+    note = row.note
+    if note == stt.OFF:
+        note = 129 if rng.random() < 0.9 else rng.randrange(130, 256)
+    elif note == stt.CLEAR:
+        note = 0
+    else:
+        note += 1
+
+    vol = row.vol
+    if vol == stt.CLEAR:
+        vol = 65 if rng.random() < 0.9 else rng.randrange(66, 256)
+
+    command = 0 if row.command == stt.CLEAR else row.command
+    controller_set = 0 if row.controller_set == stt.CLEAR else row.controller_set + 1
+
+    return (note, vol, command, row.parameter, controller_set, row.controller_value)
+
+def encode_sht2_pattern(columns, rng):
+    # Deliberately not the most compact encoding: unchanged fields are
+    # sometimes sent anyway, and runs are sometimes split, so every
+    # combination of frame header bits shows up.
+    cells = [row_to_sht2_values(row, rng) for column in columns for row in column]
+
+    data = bytearray()
+    last_values = None
+    cell_idx = 0
+
+    while cell_idx < len(cells):
+        values = cells[cell_idx]
+
+        run_length = 1
+        while cell_idx + run_length < len(cells) and cells[cell_idx + run_length] == values and run_length < 0x10000:
+            run_length += 1
+        if run_length > 1 and rng.random() < 0.2:
+            run_length = rng.randint(1, run_length)
+
+        frame_header = 0
+        frame_data = bytearray()
+        for field_idx, bit in enumerate(stt.FRAME_FIELD_BITS):
+            if last_values is None or last_values[field_idx] != values[field_idx] or rng.random() < 0.1:
+                frame_header |= bit
+                frame_data.append(values[field_idx])
+
+        if run_length > 1 or rng.random() < 0.05:
+            frame_header |= stt.FRAME_REPEAT_BIT
+            frame_data += struct.pack('>H', run_length - 1)
+
+        data.append(frame_header)
+        data += frame_data
+
+        last_values = values
+        cell_idx += run_length
+
+    return struct.pack('<I', len(data)) + data
+
+def write_sht2(song, fobj, seed=0):
+    rng = random.Random(seed)
+    song.save_to_sht2(fobj, lambda columns: encode_sht2_pattern(columns, rng))
+
+def generate_file(filename, file_format='sht2', seed=0, **size):
+    song = generate_song(seed=seed, **size)
+
+    with open(filename, 'wb') as fobj:
+        if file_format == 'sht2':
+            write_sht2(song, fobj, seed)
+        else:
+            song.save_to_fobj(fobj)
+
+#
+# - benchmarks -
+#
+
+def bench_load_sht2(files):
+    with open(files['sht2'], 'rb') as fobj:
+        stt.Song.load_from_sht2(fobj)
+
+def bench_load_sht2_columnar(files):
+    with open(files['sht2'], 'rb') as fobj:
+        stt.Song.load_from_sht2(fobj, 'columnar')
+
+def bench_load_sht2_runs(files):
+    with open(files['sht2'], 'rb') as fobj:
+        stt.Song.load_from_sht2(fobj, 'runs')
+
+def bench_convert(files):
+    stt.convert2to4(files['sht2'], files['output'], overwrite_ok=True)
+
+def bench_load_sht4(files):
+    with open(files['sht4'], 'rb') as fobj:
+        stt.Song.load_from_sht4(fobj)
+
+def bench_load_properties(files):
+    with open(files['sht4'], 'rb') as fobj:
+        stt.Properties.load_from_fobj(fobj)
+
+def bench_show_ndjson(files):
+    with open(os.devnull, 'w') as output:
+        stt.show4(files['sht4'], 'ndjson', output=output)
+
+def bench_show_pprint(files):
+    with open(os.devnull, 'w') as output:
+        stt.show4(files['sht4'], output=output)
+
+BENCHMARKS = {
+    'load_sht2': bench_load_sht2,
+    'load_sht2_columnar': bench_load_sht2_columnar,
+    'load_sht2_runs': bench_load_sht2_runs,
+    'convert': bench_convert,
+    'load_sht4': bench_load_sht4,
+    'load_properties': bench_load_properties,
+    'show_ndjson': bench_show_ndjson,
+    'show_pprint': bench_show_pprint,
+}
+
+def have_numpy():
+    try:
+        stt._require_numpy()
+    except Exception:
+        return False
+    return True
+
+def measure(benchmark, files, repeat):
+    # best-of-repeat wall time, then one more run under tracemalloc for peak
+    # memory (tracemalloc slows things down, so it isn't timed)
+    best = None
+    for run_idx in range(repeat):
+        start = time.perf_counter()
+        benchmark(files)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        benchmark(files)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best, peak_bytes
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(sizes, operations, repeat=3, seed=0, progress=None):
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size_name in sizes:
+            files = {
+                'sht2': os.path.join(tmpdir, f'{size_name}.sht'),
+                'sht4': os.path.join(tmpdir, f'{size_name}.sht4'),
+                'output': os.path.join(tmpdir, f'{size_name}.out.sht4'),
+            }
+            generate_file(files['sht2'], 'sht2', seed, **SIZES[size_name])
+            generate_file(files['sht4'], 'sht4', seed, **SIZES[size_name])
+
+            for operation in operations:
+                seconds, peak_bytes = measure(BENCHMARKS[operation], files, repeat)
+                result = {
+                    'size': size_name,
+                    'operation': operation,
+                    'seconds': seconds,
+                    'peak_bytes': peak_bytes,
+                    'sht2_bytes': os.path.getsize(files['sht2']),
+                    'sht4_bytes': os.path.getsize(files['sht4']),
+                }
+                results.append(result)
+
+                if progress is not None:
+                    progress(result)
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'seed': seed,
+        'results': results,
+    }
+
+def format_result(result):
+    return f'{result["size"]:>8} {result["operation"]:<20} {result["seconds"] * 1000:10.1f} ms {result["peak_bytes"] / (1 << 20):10.2f} MiB'
+
+def compare_results(previous, current):
+    previous_results = {(result['size'], result['operation']): result for result in previous['results']}
+
+    lines = []
+    for result in current['results']:
+        old = previous_results.get((result['size'], result['operation']))
+        if old is None:
+            continue
+
+        lines.append(f'{result["size"]:>8} {result["operation"]:<20} time x{result["seconds"] / old["seconds"]:.2f}  memory x{result["peak_bytes"] / max(old["peak_bytes"], 1):.2f}')
+
+    return lines
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='Write a synthetic song file')
+    generate_parser.add_argument('output_filename')
+    generate_parser.add_argument('--format', choices=('sht2', 'sht4'), default='sht2')
+    generate_parser.add_argument('--size', choices=sorted(SIZES), default='small', help='Preset for the options below (default: %(default)s)')
+    generate_parser.add_argument('--instruments', type=int)
+    generate_parser.add_argument('--patterns', type=int)
+    generate_parser.add_argument('--width', type=int, help='Maximum columns per instrument')
+    generate_parser.add_argument('--rows', type=int, help='Rows per pattern')
+    generate_parser.add_argument('--density', type=float, help='Fraction of non-empty notes, 0-1')
+    generate_parser.add_argument('--seed', type=int, default=0)
+
+    run_parser = subparsers.add_parser('run', help='Time load/convert/show on synthetic songs')
+    run_parser.add_argument('--sizes', default='small,medium', help='Comma-separated sizes from: ' + ', '.join(SIZES) + ' (default: %(default)s)')
+    run_parser.add_argument('--operations', default=None, help='Comma-separated benchmarks from: ' + ', '.join(BENCHMARKS) + ' (default: all)')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Timed runs per benchmark; the best is reported (default: %(default)s)')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='Write results as JSON to this file')
+    run_parser.add_argument('--compare', help='JSON results from a previous run to compare against')
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        size = dict(SIZES[args.size])
+        for option in size:
+            if getattr(args, option) is not None:
+                size[option] = getattr(args, option)
+
+        generate_file(args.output_filename, args.format, args.seed, **size)
+
+    elif args.command == 'run':
+        sizes = args.sizes.split(',')
+        for size_name in sizes:
+            if size_name not in SIZES:
+                parser.error(f'unknown size {size_name}')
+
+        if args.operations is None:
+            operations = [operation for operation in BENCHMARKS if operation != 'load_sht2_columnar' or have_numpy()]
+        else:
+            operations = args.operations.split(',')
+            for operation in operations:
+                if operation not in BENCHMARKS:
+                    parser.error(f'unknown operation {operation}')
+
+        results = run_benchmarks(sizes, operations, args.repeat, args.seed, lambda result: print(format_result(result), flush=True))
+
+        if args.output:
+            with open(args.output, 'w') as fobj:
+                json.dump(results, fobj, indent=2)
+
+        if args.compare:
+            with open(args.compare) as fobj:
+                previous = json.load(fobj)
+
+            print(f'compared to {previous.get("commit")}:')
+            for line in compare_results(previous, results):
+                print(line)
@@ -0,0 +1,3686 @@
+#
+# Shaketracker song file tools. The command line entry point is
+# shaketrackertool.py, which only imports this module and calls main(), so
+# that Python can cache this module's compiled code: a script run as
+# __main__ is compiled from source every time.
+#
+
+import struct
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping, Sequence
+from array import array
+from contextlib import closing, contextmanager, nullcontext
+from io import BytesIO
+import mmap
+import os
+import sys
+import time
+
+class FileWriter:
+    def __init__(self, fobj):
+        self.fobj = fobj
+
+    def store_byte(self, b):
+        self.fobj.write(struct.pack('B', b))
+
+    def store_pascal_string(self, s):
+        return self.store_pascal_bytes(s.encode('ascii'))
+
+    def store_pascal_bytes(self, b):
+        b = b[:255]
+        self.fobj.write(struct.pack('B', len(b)) + b)
+
+class FileReader:
+    def __init__(self, fobj):
+        self.fobj = fobj
+
+    def read_byte(self):
+        b = self.fobj.read(1)
+        if not b:
+            return None
+
+        return struct.unpack('B', b)[0]
+
+    def read_word_le(self):
+        b = self.fobj.read(2)
+        if len(b) < 2:
+            return None
+
+        return struct.unpack('<H', b)[0]
+
+    def read_dword_le(self):
+        b = self.fobj.read(4)
+        if len(b) < 4:
+            return None
+
+        return struct.unpack('<I', b)[0]
+
+    def read_word_be(self):
+        b = self.fobj.read(2)
+        if len(b) < 2:
+            return None
+
+        return struct.unpack('>H', b)[0]
+
+    def read_pascal_string(self):
+        return self.read_pascal_bytes().decode('ascii')
+
+    def read_pascal_bytes(self):
+        length = self.read_byte()
+        if length is None:
+            return None
+
+        return self.fobj.read(length)
+
+    def read_c_string(self, length):
+        return self.read_c_bytes(length).decode('ascii')
+
+    def read_c_bytes(self, length):
+        b = self.fobj.read(length)
+        if len(b) < length:
+            return None
+
+        return b.split(b'\x00')[0] # support null-terminated and not-null-terminated input
+
+    def skip(self, length):
+        self.fobj.read(length)
+
+class BufferReader:
+    # Same interface as FileReader, but over a bytes-like object (typically an
+    # mmap) with an integer cursor, so reading a field doesn't cost a read()
+    # call and a temporary bytes object.
+
+    _byte = struct.Struct('B')
+    _word_le = struct.Struct('<H')
+    _dword_le = struct.Struct('<I')
+    _word_be = struct.Struct('>H')
+
+    def __init__(self, buffer, pos=0):
+        self.buffer = memoryview(buffer)
+        self.pos = pos
+
+    def _unpack(self, fmt):
+        pos = self.pos
+        if pos + fmt.size > len(self.buffer):
+            self.pos = len(self.buffer)
+            return None
+
+        self.pos = pos + fmt.size
+        return fmt.unpack_from(self.buffer, pos)[0]
+
+    def read_byte(self):
+        pos = self.pos
+        if pos >= len(self.buffer):
+            return None
+
+        self.pos = pos + 1
+        return self.buffer[pos]
+
+    def read_word_le(self):
+        return self._unpack(self._word_le)
+
+    def read_dword_le(self):
+        return self._unpack(self._dword_le)
+
+    def read_word_be(self):
+        return self._unpack(self._word_be)
+
+    def read_pascal_string(self):
+        return self.read_pascal_bytes().decode('ascii')
+
+    def read_pascal_bytes(self):
+        length = self.read_byte()
+        if length is None:
+            return None
+
+        return self._read(length)
+
+    def read_c_string(self, length):
+        return self.read_c_bytes(length).decode('ascii')
+
+    def read_c_bytes(self, length):
+        b = self._read(length)
+        if len(b) < length:
+            return None
+
+        return b.split(b'\x00')[0] # support null-terminated and not-null-terminated input
+
+    def skip(self, length):
+        self.pos = min(self.pos + length, len(self.buffer))
+
+    def _read(self, length):
+        pos = self.pos
+        self.pos = min(pos + length, len(self.buffer))
+        return bytes(self.buffer[pos:self.pos])
+
+    def release(self):
+        self.buffer.release()
+
+@contextmanager
+def open_reader(fobj):
+    # Yields a BufferReader over fobj's remaining contents when fobj is a
+    # BytesIO or a regular file that can be memory-mapped, otherwise a
+    # FileReader (eg. for pipes). On exit, fobj is positioned just after the
+    # data that was consumed, as if it had been read directly.
+
+    if isinstance(fobj, BytesIO):
+        buffer = fobj.getbuffer()
+        reader = BufferReader(buffer, fobj.tell())
+        try:
+            yield reader
+        finally:
+            reader.release()
+            buffer.release()
+            fobj.seek(reader.pos)
+        return
+
+    try:
+        start = fobj.tell()
+        mapping = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        # not a real file, not seekable, or empty (which mmap refuses)
+        yield FileReader(fobj)
+        return
+
+    reader = BufferReader(mapping, start)
+    try:
+        yield reader
+    finally:
+        reader.release()
+        mapping.close()
+        fobj.seek(reader.pos)
+
+def map_fobj(fobj):
+    # Returns (buffer, start_offset) for fobj's remaining contents. Unlike
+    # open_reader, the buffer stays valid after fobj is closed (an mmap keeps
+    # its own handle to the file).
+    try:
+        start = fobj.tell()
+        return mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ), start
+    except (AttributeError, OSError, ValueError):
+        return fobj.read(), 0
+
+
+#
+# Profiling. Code reports stage timings and counters through profile_stage()
+# and profile_count(); unless a Profile is active (see profiling()), those
+# cost a global lookup and a None check, so they're only called at pattern
+# granularity, never per frame or per cell.
+#
+
+class Profile:
+    def __init__(self):
+        self.timers = OrderedDict() # stage name => [seconds, calls]
+        self.counters = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += time.perf_counter() - start
+            timer[1] += 1
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self):
+        derived = OrderedDict()
+
+        if self.counters.get('frames_decoded'):
+            derived['repeat_expansion_ratio'] = self.counters['cells_decoded'] / self.counters['frames_decoded']
+
+        return OrderedDict((
+            ('timers', OrderedDict((name, {'seconds': seconds, 'calls': calls}) for name, (seconds, calls) in self.timers.items())),
+            ('counters', self.counters),
+            ('derived', derived),
+        ))
+
+    def save(self, filename):
+        import json
+
+        with open(filename, 'w') as fobj:
+            json.dump(self.to_dict(), fobj, indent=2)
+            fobj.write('\n')
+
+_active_profile = None
+
+@contextmanager
+def profiling(profile=None):
+    global _active_profile
+
+    profile = profile or Profile()
+    previous_profile = _active_profile
+    _active_profile = profile
+    try:
+        yield profile
+    finally:
+        _active_profile = previous_profile
+
+def profile_stage(name):
+    if _active_profile is None:
+        return nullcontext()
+    return _active_profile.stage(name)
+
+def profile_count(name, amount=1):
+    if _active_profile is not None:
+        _active_profile.count(name, amount)
+
+
+class PropertySection(Mapping):
+    # One section's properties, in insertion order, readable like a dict of
+    # str. Values are kept encoded, back to back in a single bytearray with an
+    # array of end offsets, and are only decoded when looked up; names are
+    # interned. A section with thousands of note_N properties therefore costs
+    # a handful of objects rather than several per property.
+
+    __slots__ = ('_positions', '_values', '_ends')
+
+    def __init__(self):
+        self._positions = {}
+        self._values = bytearray()
+        self._ends = array('I')
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __contains__(self, property_name):
+        return property_name in self._positions
+
+    def __getitem__(self, property_name):
+        return self.get_bytes(property_name).decode('ascii')
+
+    def __repr__(self):
+        return f'{type(self).__name__}({list(self.items())!r})'
+
+    def get_bytes(self, property_name):
+        return self._value_at(self._positions[property_name])
+
+    def items_bytes(self):
+        for position, property_name in enumerate(self._positions):
+            yield property_name, self._value_at(position)
+
+    def filtered(self, property_filter):
+        # a new PropertySection of the properties whose name property_filter
+        # accepts
+        section = PropertySection()
+        for position, property_name in enumerate(self._positions):
+            if property_filter(property_name):
+                section.setdefault_bytes(property_name, self._value_at(position))
+        return section
+
+    def setdefault_bytes(self, property_name, value):
+        if property_name not in self._positions:
+            self._positions[sys.intern(property_name)] = len(self._ends)
+            self._values += value
+            self._ends.append(len(self._values))
+
+    def sort(self):
+        items = sorted(self.items_bytes())
+
+        self._positions = {}
+        self._values = bytearray()
+        self._ends = array('I')
+
+        for property_name, value in items:
+            self.setdefault_bytes(property_name, value)
+
+    def _value_at(self, position):
+        start = self._ends[position - 1] if position else 0
+        return bytes(self._values[start:self._ends[position]])
+
+class Section:
+    def __init__(self, properties, section_name):
+        self._properties = properties
+        self._section_name = section_name
+
+    def add_property(self, property_name, value):
+        self._properties.add_property(self._section_name, property_name, value)
+
+class Properties:
+    CHUNK_SECTION = 0
+    CHUNK_VARIABLE = 1
+
+    @classmethod
+    def load_from_fobj(cls, fobj, header_check=None, section_filter=None, property_filter=None):
+        return cls._load_from_sections(cls.iter_sections(fobj, header_check, section_filter, property_filter), header_check)
+
+    @classmethod
+    def load_from_buffer(cls, buffer, start=0, header_check=None, section_filter=None, property_filter=None):
+        # Same as load_from_fobj, for data already in memory (or mapped)
+        return cls._load_from_sections(cls._iter_sections_from_reader(BufferReader(buffer, start), header_check, section_filter, property_filter), header_check)
+
+    @classmethod
+    def _load_from_sections(cls, sections, header_check):
+        props = Properties(header_check)
+
+        for section_name, properties in sections:
+            section = props._sections.setdefault(section_name, properties)
+            if section is not properties:
+                # repeated section; merge like add_property would
+                for property_name, property_value in properties.items_bytes():
+                    section.setdefault_bytes(property_name, property_value)
+
+        return props
+
+    @classmethod
+    def iter_sections(cls, fobj, header_check=None, section_filter=None, property_filter=None):
+        # Yields (section_name, PropertySection) for each section as
+        # it's read, so only one section is held in memory at a time. If
+        # section_filter is given, sections whose name it rejects are skipped
+        # over without being stored; likewise for properties whose name
+        # property_filter rejects.
+        with open_reader(fobj) as reader:
+            yield from cls._iter_sections_from_reader(reader, header_check, section_filter, property_filter)
+
+    @classmethod
+    def _iter_sections_from_reader(cls, reader, header_check=None, section_filter=None, property_filter=None):
+        if header_check is not None:
+            header_tag = reader.read_pascal_string()
+            if header_tag != header_check:
+                raise Exception(f'Expected to read {header_check} but read {header_tag} instead')
+
+        section_name = None
+        section = None
+
+        while True:
+            chunk = reader.read_byte()
+
+            if chunk is None:
+                # done/eof
+                break
+
+            elif chunk == Properties.CHUNK_SECTION:
+                if section is not None:
+                    yield section_name, section
+
+                section_name = sys.intern(reader.read_pascal_string())
+                profile_count('sections_read')
+
+                if section_filter is None or section_filter(section_name):
+                    section = PropertySection()
+                else:
+                    section = None
+
+            elif chunk == Properties.CHUNK_VARIABLE:
+                if section_name is None:
+                    raise Exception('Found a property before any section')
+
+                if section is None:
+                    # skipped section
+                    reader.skip(reader.read_byte() or 0)
+                    reader.skip(reader.read_byte() or 0)
+                else:
+                    property_name = reader.read_pascal_string()
+                    if property_filter is None or property_filter(property_name):
+                        section.setdefault_bytes(property_name, reader.read_pascal_bytes())
+                    else:
+                        reader.skip(reader.read_byte() or 0)
+
+        if section is not None:
+            yield section_name, section
+
+    def __init__(self, header_check=None):
+        self.header_check = header_check
+
+        self._sections = OrderedDict()
+
+    def sort(self):
+        for k in sorted(self._sections.keys()):
+            self._sections.move_to_end(k)
+            self._sections[k].sort()
+
+    def add_section(self, section_name):
+        self._get_section(section_name)
+        return Section(self, section_name)
+
+    def add_property(self, section_name, property_name, value):
+        self._get_section(section_name).setdefault_bytes(property_name, str(value).encode('ascii'))
+
+    def to_ordered_dict(self):
+        return OrderedDict((section_name, OrderedDict(properties.items())) for section_name, properties in self._sections.items())
+
+    def _get_section(self, section_name):
+        section = self._sections.get(section_name)
+        if section is None:
+            section = self._sections[sys.intern(section_name)] = PropertySection()
+        return section
+
+    def update(self, other_properties):
+        self._sections.update(other_properties._sections)
+
+    def save_to_fobj(self, fobj):
+        PropertiesWriter(fobj, self.header_check).write_properties(self)
+
+class PropertiesWriter:
+    # Writes the same format as Properties.save_to_fobj, but emits each
+    # section and property as soon as it's added instead of collecting them
+    # first. That means the caller is responsible for ordering, and for not
+    # adding a section or property twice (Properties would merge/ignore
+    # those).
+    #
+    # add_section returns the writer itself, so code written against
+    # Properties/Section (section = props.add_section(...);
+    # section.add_property(...)) works unchanged, as long as properties are
+    # only added to the most recently added section.
+
+    def __init__(self, fobj, header_check=None):
+        self._writer = FileWriter(fobj)
+
+        if header_check is not None:
+            self._writer.store_pascal_string(header_check)
+
+    def add_section(self, section_name):
+        self._writer.store_byte(Properties.CHUNK_SECTION)
+        self._writer.store_pascal_string(section_name)
+        return self
+
+    def add_property(self, property_name, value):
+        self.add_property_bytes(property_name, str(value).encode('ascii'))
+
+    def add_property_bytes(self, property_name, value):
+        self._writer.store_byte(Properties.CHUNK_VARIABLE)
+        self._writer.store_pascal_string(property_name)
+        self._writer.store_pascal_bytes(value)
+
+    def write_properties(self, properties):
+        for section_name, section_properties in properties._sections.items():
+            self.add_section(section_name)
+
+            for property_name, property_value in section_properties.items_bytes():
+                self.add_property_bytes(property_name, property_value)
+
+    def write_raw(self, data):
+        # data must already be serialized sections/properties (no header),
+        # e.g. the output of another PropertiesWriter
+        self._writer.fobj.write(data)
+
+
+_standard_device_properties_raw = b'\x00\rDEVICE 0 INFO\x01\x10bank_0_patch_122\tSea Shore\x01\x10bank_0_patch_117\x0bMelodic Tom\x01\x0fbank_0_patch_96\x0bFX 1 (Rain)\x01\x10bank_0_patch_123\nBird Tweet\x01\x10bank_0_patch_118\nSynth Drum\x01\x0fbank_0_patch_97\x11FX 2 (Soundtrack)\x01\x10bank_0_patch_124\x0eTelephone Ring\x01\x10bank_0_patch_119\x0eReverse Cymbal\x01\x0fbank_0_patch_98\x0eFX 3 (Crystal)\x01\x10bank_0_patch_125\nHelicopter\x01\x0fbank_0_patch_99\x11FX 4 (Atmosphere)\x01\x10bank_0_patch_126\x08Applause\x01\x10bank_0_patch_127\x08Gun Shot\x01\x14bank_0_select_string\x00\x01\nbank_0_MSB\x010\x01\x0ebank_0_patch_0\x14Acoustic Grand Piano\x01\x0ebank_0_patch_1\x15Brigth Acoustic Piano\x01\x0ebank_0_patch_2\x0eElectric Grand\x01\x04name\x0bNull Output\x01\x0ebank_0_patch_3\x10Honky Tonk Piano\x01\x0ebank_0_patch_4\x10Electric Piano 1\x01\x0ebank_0_patch_5\x10Electric Piano 2\x01\x0ebank_0_patch_6\x0bHarpsichord\x01\x0ebank_0_patch_7\x08Clavinet\x01\x0ebank_0_patch_8\x07Celesta\x01\x0ebank_0_patch_9\x0cGlockenspiel\x01\x0bbank_0_name\x0cGeneral Midi\x01\x0ehardware_index\x010\x01\x0fbank_0_patch_10\tMusic Box\x01\x0fbank_0_patch_11\nVibraphone\x01\x0fbank_0_patch_12\x07Marimba\x01\x0fbank_0_patch_13\tXylophone\x01\x0fbank_0_patch_14\rTubular Bells\x01\x0fbank_0_patch_20\nReed Organ\x01\x0fbank_0_patch_15\x08Dulcimer\x01\x0fbank_0_patch_21\tAccordion\x01\x0fbank_0_patch_16\rDrawbar Organ\x01\x0fbank_0_patch_22\tHarmonica\x01\x0fbank_0_patch_17\x0fPercusive Organ\x01\x05banks\x011\x01\x0fbank_0_patch_23\x0fTango Accordion\x01\x0fbank_0_patch_18\nRock Organ\x01\x0fbank_0_patch_24\x13Nylon String Guitar\x01\x0fbank_0_patch_19\x0cChurch Organ\x01\x0fbank_0_patch_30\x11Distortion Guitar\x01\x0fbank_0_patch_25\x13Steel String Guitar\x01\x0fbank_0_patch_31\x10Guitar Harmonics\x01\x0fbank_0_patch_26\x14Electric Jazz Guitar\x01\x0fbank_0_patch_32\rAcoustic Bass\x01\x0fbank_0_patch_27\x15Electric Clean Guitar\x01\x0fbank_0_patch_33\x14Electric Bass(pluck)\x01\x0fbank_0_patch_28\x15Electric Muted Guitar\x01\x0fbank_0_patch_34\x15Electric Bass(finger)\x01\x0fbank_0_patch_29\x11Overdriven Guitar\x01\x0fbank_0_patch_40\x06Violin\x01\x0fbank_0_patch_35\rFretless Bass\x01\x0fbank_0_patch_41\x05Viola\x01\x0fbank_0_patch_36\x0bSlap Bass 1\x01\x0fbank_0_patch_42\x05Cello\x01\x0fbank_0_patch_37\x0bSlap Bass 2\x01\x0fbank_0_patch_43\x0bCounterBass\x01\x0fbank_0_patch_38\x0cSynth Bass 1\x01\x0fbank_0_patch_44\x0fTremolo Strings\x01\x0fbank_0_patch_39\x0cSynth Bass 2\x01\rbank_0_method\x010\x01\x0fbank_0_patch_50\x0fSynth Strings 1\x01\x0fbank_0_patch_45\x11Pizzicato Strings\x01\x0fbank_0_patch_51\x0fSynth Strings 2\x01\x0fbank_0_patch_46\x0fOrchestral Harp\x01\x0fbank_0_patch_52\nChoir Aahs\x01\x0fbank_0_patch_47\x07Timpani\x01\x0fbank_0_patch_53\nVoice Oohs\x01\x0fbank_0_patch_48\x11String Ensemble 1\x01\x0fbank_0_patch_54\x0bSynth Voice\x01\x0fbank_0_patch_49\x11String Ensemble 2\x01\x0fbank_0_patch_60\x0bFrench Horn\x01\x0fbank_0_patch_55\rOrchestra Hit\x01\x0fbank_0_patch_61\rBrass Section\x01\x0fbank_0_patch_56\x07Trumpet\x01\x0fbank_0_patch_62\x0cSynthBrass 1\x01\x0fbank_0_patch_57\x08Trombone\x01\x0fbank_0_patch_63\x0cSynthBrass 2\x01\x0fbank_0_patch_58\x04Tuba\x01\x0fbank_0_patch_64\x0bSoprano Sax\x01\x0fbank_0_patch_59\rMuted Trumpet\x01\x0fbank_0_patch_70\x07Bassoon\x01\x0fbank_0_patch_65\tTenor Sax\x01\x0fbank_0_patch_71\x08Clarinet\x01\x0fbank_0_patch_66\x08Alto Sax\x01\x0fbank_0_patch_72\x07Piccolo\x01\x0fbank_0_patch_67\x0cBaritone Sax\x01\x0fbank_0_patch_73\x05Flute\x01\x0fbank_0_patch_68\x04Oboe\x01\x10bank_0_patch_100\x11FX 5 (Brightness)\x01\x0fbank_0_patch_74\x08Recorder\x01\x0fbank_0_patch_69\x0cEnglish Horn\x01\x10bank_0_patch_101\x0eFX 6 (Goblins)\x01\x0fbank_0_patch_80\x0fLead 1 (Square)\x01\x0fbank_0_patch_75\tPan Flute\x01\x10bank_0_patch_102\rFX 7 (echoes)\x01\x0fbank_0_patch_81\x11Lead 2 (SawTooth)\x01\x0fbank_0_patch_76\x0cBlown Bottle\x01\x10bank_0_patch_103\rFX 8 (sci-fi)\x01\x0fbank_0_patch_82\x11Lead 3 (Calliope)\x01\x0fbank_0_patch_77\nSkakukachi\x01\x10bank_0_patch_104\x05Sitar\x01\x0fbank_0_patch_83\x0eLead 4 (Chiff)\x01\x0fbank_0_patch_78\x07Whistle\x01\x10bank_0_patch_110\x06Fiddle\x01\x10bank_0_patch_105\x05Banjo\x01\x0fbank_0_patch_84\x10Lead 5 (Charang)\x01\x0fbank_0_patch_79\x07Ocarina\x01\x10bank_0_patch_111\x06Shanai\x01\x10bank_0_patch_106\x08Shamisen\x01\x0fbank_0_patch_90\x11Pad 3 (PolySynth)\x01\x0fbank_0_patch_85\x0eLead 6 (Voice)\x01\x10bank_0_patch_112\x0bTinkle Bell\x01\x10bank_0_patch_107\x04Koto\x01\x0fbank_0_patch_91\rPad 4 (Choir)\x01\x0fbank_0_patch_86\x0fLead 7 (Fifths)\x01\x10bank_0_patch_113\x05Agogo\x01\x10bank_0_patch_108\x07Kalimba\x01\x0fbank_0_patch_92\rPad 5 (Bowed)\x01\x0fbank_0_patch_87\x12Lead 8 (Bass+Lead)\x01\x10bank_0_patch_114\x0bSteel Drums\x01\x10bank_0_patch_109\x07BagPipe\x01\x0fbank_0_patch_93\x10Pad 6 (Metallic)\x01\x0fbank_0_patch_88\x0fPad 1 (New Age)\x01\x10bank_0_patch_120\x11Guitar Fret Noise\x01\x10bank_0_patch_115\nWood Block\x01\x0fbank_0_patch_94\rPad 7 (Hallo)\x01\x0fbank_0_patch_89\x0cPad 2 (Warm)\x01\x10bank_0_patch_121\x0cBreath Noise\x01\x10bank_0_patch_116\nTaiko Drum\x01\x0fbank_0_patch_95\rPad 8 (Sweep)\x01\nbank_0_LSB\x010'
+
+_standard_device_properties = None
+
+def standard_device_properties():
+    # Parsed form of _standard_device_properties_raw. Saving writes the raw
+    # bytes directly, so this is only built if someone wants to inspect it.
+    global _standard_device_properties
+
+    if _standard_device_properties is None:
+        _standard_device_properties = Properties.load_from_fobj(BytesIO(_standard_device_properties_raw))
+    return _standard_device_properties
+
+SAVE_BUFFER_SIZE = 1 << 20
+READ_BUFFER_SIZE = 1 << 20
+SHT2_VERSION = 2
+SHT2_ORDER_COUNT = 500
+
+SHT4_HEADER = 'ShakeTracker Module'
+
+PatternMetrics = namedtuple('PatternMetrics', ('length', 'highlight_major', 'highlight_minor'))
+
+Instrument = namedtuple('Instrument', ('name', 'track_width', 'device', 'bank', 'patch', 'channel', 'pitch_bend_sensitivity', 'default_volume', 'global_volume'))
+
+CLEAR = '<CLEAR>'
+OFF = '<OFF>'
+
+class Row(namedtuple('Row', ('note', 'vol', 'command', 'parameter', 'controller_set', 'controller_value'))):
+    def _is_empty(self):
+        return self.note == CLEAR and self.vol == CLEAR and self.command == CLEAR and self.parameter == 0 and self.controller_set == CLEAR and self.controller_value == 0
+
+#
+# Interning. Songs repeat themselves: the same Row turns up all over a song,
+# and often the same column (a drum part, a bass line) in many patterns and
+# instruments. Decoding hands out one shared instance of each, so columns
+# are tuples rather than lists, and must be replaced rather than modified.
+# Each load has its own InternTable, passed down to the decoders, so nothing
+# is kept alive once the song it was decoded for is gone. (A lazily loaded
+# song uses a new table per pattern block, so evicted blocks can be freed.)
+#
+
+class InternTable:
+    __slots__ = ('_rows', '_columns', '_rows_by_values')
+
+    def __init__(self):
+        self._rows = {}
+        self._columns = {}
+        self._rows_by_values = {}
+
+    def row(self, row):
+        return self._rows.setdefault(row, row)
+
+    def column(self, column):
+        # column is a tuple of Rows (or of Runs)
+        interned = self._columns.setdefault(column, column)
+        if interned is not column:
+            profile_count('columns_shared')
+        return interned
+
+    def row_from_values(self, values, to_row):
+        # interned to_row(values), for decoders that see the same raw values
+        # over and over
+        key = (to_row, tuple(values))
+        row = self._rows_by_values.get(key)
+        if row is None:
+            row = self._rows_by_values[key] = self.row(to_row(values))
+        return row
+
+# sht2 frame header bits for note, vol, command, parameter, controller_set,
+# controller_value (in that order); 0x02 means a repeat count follows
+FRAME_FIELD_BITS = (0x80, 0x40, 0x20, 0x10, 0x08, 0x04)
+FRAME_REPEAT_BIT = 0x02
+
+def read_pattern_frames(reader, num_cells):
+    # Returns [(fields, repeat_count), ...] for one pattern, where fields are
+    # the raw sht2 byte values (with unchanged fields carried over from the
+    # previous frame).
+    pattern_data_length = reader.read_dword_le()
+    bytes_read = 0
+
+    cells_added = 0
+    frames = []
+
+    last_fields = None
+
+    while cells_added < num_cells:
+        repeat_count = 1
+
+        frame_header = reader.read_byte()
+        bytes_read += 1
+
+        fields = []
+        for field_idx, bit in enumerate(FRAME_FIELD_BITS):
+            if frame_header & bit:
+                fields.append(reader.read_byte())
+                bytes_read += 1
+            else:
+                fields.append(last_fields[field_idx])
+
+        if frame_header & FRAME_REPEAT_BIT:
+            repeat_count = reader.read_word_be() + 1
+            bytes_read += 2
+
+        frames.append((fields, repeat_count))
+        cells_added += repeat_count
+
+        last_fields = fields
+
+    if bytes_read != pattern_data_length:
+        raise Exception(f'Expected {pattern_data_length} bytes of pattern data, actually read {bytes_read}')
+
+    if _active_profile is not None:
+        _active_profile.count('patterns_decoded')
+        _active_profile.count('frames_decoded', len(frames))
+        _active_profile.count('cells_decoded', num_cells)
+        _active_profile.count('pattern_bytes_read', bytes_read + 4)
+
+    return frames
+
+def sht2_fields_to_row(fields):
+    note, vol, command, parameter, controller_set, controller_value = fields
+
+    if note > 128:
+        note = OFF
+    elif note == 0:
+        note = CLEAR
+    else:
+        note -= 1
+
+    if vol > 64:
+        vol = CLEAR
+
+    if command == 0:
+        command = CLEAR
+
+    if controller_set == 0:
+        controller_set = CLEAR
+    else:
+        controller_set -= 1
+
+    return Row(note, vol, command, parameter, controller_set, controller_value)
+
+def decode_pattern_data(reader, num_columns, num_rows, interner=None):
+    # interner is the load's InternTable (each call gets its own if None);
+    # likewise for the other decode_pattern_data* functions
+    if interner is None:
+        interner = InternTable()
+
+    all_rows = []
+
+    for fields, repeat_count in read_pattern_frames(reader, num_rows * num_columns):
+        all_rows.extend([interner.row_from_values(fields, sht2_fields_to_row)] * repeat_count)
+
+    columns = []
+
+    for column_idx in range(num_columns):
+        columns.append(interner.column(tuple(all_rows[num_rows * column_idx:num_rows * (column_idx + 1)])))
+
+    return columns
+
+#
+# Columnar (numpy) pattern storage. Instead of lists of Rows, each
+# instrument pattern is a (num_columns, num_rows) array of CELL_DTYPE, with
+# values already in their sht4 encoding, so CLEAR/OFF become the numeric
+# sentinels below.
+#
+# sht4 can't tell command 255 apart from CLEAR, but sht2 can, so each cell
+# also has a command_set flag, which is what says whether there's a command
+# (a cell whose only content is command 255 isn't empty). Cells read from
+# sht4 get it from the command being anything but 255, as Rows do.
+#
+
+CELL_FIELDS = Row._fields
+CELL_NOTE_OFF = 254
+CELL_NOTE_CLEAR = 255
+CELL_VOL_CLEAR = 65
+CELL_COMMAND_CLEAR = 255
+CELL_CONTROLLER_SET_CLEAR = 255
+CELL_EMPTY = (CELL_NOTE_CLEAR, CELL_VOL_CLEAR, CELL_COMMAND_CLEAR, 0, CELL_CONTROLLER_SET_CLEAR, 0)
+CELL_EMPTY_FLAGGED = CELL_EMPTY + (False,)
+
+# numpy is optional and slow to import, so it's only loaded when the columnar
+# backend is actually requested
+numpy = None
+CELL_DTYPE = None
+
+def _require_numpy():
+    global numpy, CELL_DTYPE
+
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            raise Exception('The columnar backend requires numpy, which is not installed')
+
+        CELL_DTYPE = numpy.dtype([(field, numpy.uint8) for field in CELL_FIELDS] + [('command_set', numpy.bool_)])
+
+def decode_pattern_data_columnar(reader, num_columns, num_rows, interner=None):
+    # (nothing to intern)
+    num_cells = num_rows * num_columns
+    frames = read_pattern_frames(reader, num_cells)
+
+    values = numpy.array([fields for fields, repeat_count in frames], dtype=numpy.uint8).reshape(-1, len(CELL_FIELDS))
+    repeat_counts = numpy.array([repeat_count for fields, repeat_count in frames], dtype=numpy.int64)
+
+    values = numpy.repeat(values, repeat_counts, axis=0)[:num_cells]
+    note, vol, command, parameter, controller_set, controller_value = values.T
+
+    cells = numpy.empty(num_cells, dtype=CELL_DTYPE)
+    cells['note'] = numpy.where(note == 0, CELL_NOTE_CLEAR, numpy.where(note > 128, CELL_NOTE_OFF, note - 1))
+    cells['vol'] = numpy.where(vol > 64, CELL_VOL_CLEAR, vol)
+    cells['command'] = numpy.where(command == 0, CELL_COMMAND_CLEAR, command)
+    cells['command_set'] = command != 0
+    cells['parameter'] = parameter
+    cells['controller_set'] = numpy.where(controller_set == 0, CELL_CONTROLLER_SET_CLEAR, controller_set - 1)
+    cells['controller_value'] = controller_value
+
+    return cells.reshape(num_columns, num_rows)
+
+def columnar_nonempty_mask(cells):
+    mask = cells['command_set'].copy()
+    for field, empty_value in zip(CELL_FIELDS, CELL_EMPTY):
+        if field != 'command':
+            mask |= cells[field] != empty_value
+    return mask
+
+def columnar_cell_to_row(cell):
+    # cell is one CELL_DTYPE cell as a tuple (as from tolist())
+    row = sht4_values_to_row(cell[:6])
+    if cell[6] and row.command == CLEAR:
+        row = row._replace(command=CELL_COMMAND_CLEAR)
+    return row
+
+def is_columnar(columns):
+    return numpy is not None and isinstance(columns, numpy.ndarray)
+
+#
+# Run-length pattern storage. Keeps the sht2 repeat runs instead of expanding
+# them: each column is a tuple of Runs of one non-empty Row, in row order, and
+# any row not covered by a run is empty. Memory and the work to find
+# non-empty cells are proportional to the number of runs, not to
+# columns * rows.
+#
+
+Run = namedtuple('Run', ('row', 'start', 'length'))
+
+class PatternRuns:
+    __slots__ = ('num_rows', 'columns')
+
+    @classmethod
+    def from_columns(cls, columns, num_rows, interner=None):
+        # from lists of Rows
+        if interner is None:
+            interner = InternTable()
+
+        runs_columns = []
+
+        for rows in columns:
+            runs = []
+            for row_idx, row in enumerate(rows):
+                if row._is_empty():
+                    continue
+
+                if runs and runs[-1].row == row and runs[-1].start + runs[-1].length == row_idx:
+                    runs[-1] = runs[-1]._replace(length=runs[-1].length + 1)
+                else:
+                    runs.append(Run(row, row_idx, 1))
+            runs_columns.append(interner.column(tuple(runs)))
+
+        return cls(num_rows, runs_columns)
+
+    def __init__(self, num_rows, columns):
+        self.num_rows = num_rows
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __eq__(self, other):
+        return isinstance(other, PatternRuns) and self.num_rows == other.num_rows and self.columns == other.columns
+
+    def __repr__(self):
+        return f'PatternRuns({self.num_rows!r}, {self.columns!r})'
+
+    def expand(self):
+        # as lists of Rows
+        columns = []
+
+        for runs in self.columns:
+            rows = [EMPTY_ROW] * self.num_rows
+            for run in runs:
+                rows[run.start:run.start + run.length] = [run.row] * run.length
+            columns.append(rows)
+
+        return columns
+
+def decode_pattern_data_runs(reader, num_columns, num_rows, interner=None):
+    if interner is None:
+        interner = InternTable()
+
+    num_cells = num_rows * num_columns
+    columns = [[] for column_idx in range(num_columns)]
+
+    cell_idx = 0
+
+    for fields, repeat_count in read_pattern_frames(reader, num_cells):
+        row = interner.row_from_values(fields, sht2_fields_to_row)
+        run_end = min(cell_idx + repeat_count, num_cells)
+
+        if not row._is_empty():
+            # columns are stacked, so a run can carry on into the next column
+            while cell_idx < run_end:
+                column_idx, start = divmod(cell_idx, num_rows)
+                length = min(run_end - cell_idx, num_rows - start)
+                columns[column_idx].append(Run(row, start, length))
+                cell_idx += length
+
+        cell_idx = run_end
+
+    return PatternRuns(num_rows, [interner.column(tuple(runs)) for runs in columns])
+
+PATTERN_STORAGES = ('rows', 'columnar', 'runs')
+
+def pattern_decoder(storage):
+    # Returns the decode_pattern_data* function for a storage in
+    # PATTERN_STORAGES
+    if storage == 'rows':
+        return decode_pattern_data
+    elif storage == 'columnar':
+        _require_numpy()
+        return decode_pattern_data_columnar
+    elif storage == 'runs':
+        return decode_pattern_data_runs
+    else:
+        raise Exception(f'Unknown pattern storage {storage}')
+
+def pattern_rows(columns):
+    # One instrument pattern, in any storage, as lists of Rows
+    if isinstance(columns, PatternRuns):
+        return columns.expand()
+    if is_columnar(columns):
+        return [[columnar_cell_to_row(cell) for cell in column] for column in columns.tolist()]
+    return [list(column) for column in columns]
+
+def count_pattern_cells(columns):
+    if is_columnar(columns):
+        return columns.size
+    elif isinstance(columns, PatternRuns):
+        return len(columns) * columns.num_rows
+    else:
+        return sum(len(rows) for rows in columns)
+
+def row_to_sht2_fields(row):
+    # Inverse of sht2_fields_to_row, using 129 for OFF and 65 for no vol
+    note = row.note
+    if note == OFF:
+        note = 129
+    elif note == CLEAR:
+        note = 0
+    elif 0 <= note < 128:
+        note += 1
+    else:
+        raise Exception(f'Note {note} can\'t be stored in sht2')
+
+    vol = 65 if row.vol == CLEAR else row.vol
+    command = 0 if row.command == CLEAR else row.command
+    controller_set = 0 if row.controller_set == CLEAR else row.controller_set + 1
+
+    return (note, vol, command, row.parameter, controller_set, row.controller_value)
+
+def iter_stacked_cell_runs(columns):
+    # Yields (sht2_fields, count) for one instrument pattern's columns stacked
+    # end to end (the order sht2 stores them in), with identical neighbouring
+    # cells always combined, for any pattern storage
+    empty_fields = row_to_sht2_fields(EMPTY_ROW)
+
+    if isinstance(columns, PatternRuns):
+        cell_runs = []
+        for runs in columns.columns:
+            row_idx = 0
+            for run in runs:
+                if run.start > row_idx:
+                    cell_runs.append((empty_fields, run.start - row_idx))
+                cell_runs.append((row_to_sht2_fields(run.row), run.length))
+                row_idx = run.start + run.length
+            if columns.num_rows > row_idx:
+                cell_runs.append((empty_fields, columns.num_rows - row_idx))
+    else:
+        # runs of Rows, or of sht4 value tuples for columnar storage
+        columnar = is_columnar(columns)
+        if columnar:
+            columns = columns.tolist()
+
+        cell_runs = []
+        last_row = None
+        for rows in columns:
+            for row in rows:
+                if row is last_row or row == last_row:
+                    cell_runs[-1][1] += 1
+                else:
+                    cell_runs.append([row, 1])
+                    last_row = row
+
+        if columnar:
+            cell_runs = [(row_to_sht2_fields(columnar_cell_to_row(cell)), count) for cell, count in cell_runs]
+        else:
+            cell_runs = [(row_to_sht2_fields(row), count) for row, count in cell_runs]
+
+    fields = None
+    count = 0
+    for run_fields, run_count in cell_runs:
+        if run_fields == fields:
+            count += run_count
+            continue
+
+        if count:
+            yield fields, count
+        fields = run_fields
+        count = run_count
+
+    if count:
+        yield fields, count
+
+def encode_pattern_data(columns):
+    # Returns one instrument pattern as an sht2 pattern block (length prefix
+    # included) as decode_pattern_data reads it. Each frame carries only the
+    # fields that differ from the previous frame. A run of 4 or more
+    # identical cells (up to 65536 per frame) takes the 2-byte repeat count;
+    # a shorter one is cheaper as 1-byte 0x00 frames, which repeat the
+    # previous cell (3 is a tie). So a pattern takes as few bytes as the
+    # format allows, in time linear in its cells.
+    data = bytearray()
+    last_fields = None
+
+    for fields, count in iter_stacked_cell_runs(columns):
+        while count:
+            frame_count = min(count, 0x10000)
+            count -= frame_count
+
+            frame_header = 0
+            frame_data = bytearray()
+            for field_idx, bit in enumerate(FRAME_FIELD_BITS):
+                if last_fields is None or fields[field_idx] != last_fields[field_idx]:
+                    frame_header |= bit
+                    frame_data.append(fields[field_idx])
+
+            if frame_count >= 4:
+                frame_header |= FRAME_REPEAT_BIT
+                frame_data += struct.pack('>H', frame_count - 1)
+
+            data.append(frame_header)
+            data += frame_data
+            if frame_count < 4:
+                data += bytes(frame_count - 1)
+            last_fields = fields
+
+    profile_count('pattern_bytes_written', len(data) + 4)
+
+    return struct.pack('<I', len(data)) + data
+
+
+PatternBlock = namedtuple('PatternBlock', ('offset', 'length', 'num_columns', 'num_rows'))
+
+class PatternBlockCache:
+    # Decodes instrument pattern blocks out of a song buffer on demand,
+    # keeping at most max_blocks decoded blocks (None means no limit).
+
+    def __init__(self, buffer, decode, max_blocks=None):
+        self.buffer = buffer
+        self.decode = decode
+        self.max_blocks = max_blocks
+
+        self._decoded = OrderedDict()
+
+    def index_patterns(self, reader, num_columns, pattern_metrics):
+        # Skips over one instrument's pattern blocks using their length
+        # prefixes, and returns a lazy sequence of their decoded columns.
+        blocks = []
+
+        for metrics in pattern_metrics:
+            offset = reader.pos
+            length = reader.read_dword_le()
+            if length is None:
+                raise Exception(f'Unexpected end of file reading pattern data length at offset {offset}')
+
+            reader.skip(length)
+            blocks.append(PatternBlock(offset, length, num_columns, metrics.length))
+
+        return LazyPatterns(self, blocks)
+
+    def load(self, block):
+        columns = self._decoded.get(block.offset)
+        if columns is not None:
+            self._decoded.move_to_end(block.offset)
+            return columns
+
+        reader = BufferReader(self.buffer, block.offset)
+        try:
+            columns = self.decode(reader, block.num_columns, block.num_rows)
+        finally:
+            reader.release()
+
+        self._decoded[block.offset] = columns
+        if self.max_blocks is not None and len(self._decoded) > self.max_blocks:
+            self._decoded.popitem(last=False)
+
+        return columns
+
+    def close(self):
+        # Unmaps the song buffer (if it's a map); blocks that were already
+        # decoded stay usable
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+def skip_pattern_blocks(reader, num_columns, pattern_metrics):
+    # Stands in for decoding one instrument's pattern blocks when only the
+    # rest of the song is wanted
+    for pattern_idx in range(len(pattern_metrics)):
+        length = reader.read_dword_le()
+        if length is None:
+            raise Exception(f'Unexpected end of file reading pattern {pattern_idx} data length')
+
+        reader.skip(length)
+
+    return []
+
+class LazyPatterns(Sequence):
+    # Stands in for one instrument's list of patterns in Song.rows
+
+    def __init__(self, cache, blocks):
+        self.cache = cache
+        self.blocks = blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, pattern_idx):
+        if isinstance(pattern_idx, slice):
+            return [self.cache.load(block) for block in self.blocks[pattern_idx]]
+
+        return self.cache.load(self.blocks[pattern_idx])
+
+    def close(self):
+        self.cache.close()
+
+def row_to_sht4_values(row):
+    note = row.note
+    if note == OFF:
+        note = CELL_NOTE_OFF
+    elif note == CLEAR:
+        note = CELL_NOTE_CLEAR
+
+    vol = row.vol
+    if vol == CLEAR:
+        vol = CELL_VOL_CLEAR
+
+    command = row.command
+    if command == CLEAR:
+        command = CELL_COMMAND_CLEAR
+
+    controller_set = row.controller_set
+    if controller_set == CLEAR:
+        controller_set = CELL_CONTROLLER_SET_CLEAR
+
+    return (note, vol, command, row.parameter, controller_set, row.controller_value)
+
+def sht4_values_to_row(values):
+    note, vol, command, parameter, controller_set, controller_value = values
+
+    if note == CELL_NOTE_OFF:
+        note = OFF
+    elif note == CELL_NOTE_CLEAR:
+        note = CLEAR
+
+    if vol > 64:
+        vol = CLEAR
+
+    if command == CELL_COMMAND_CLEAR:
+        command = CLEAR
+
+    if controller_set == CELL_CONTROLLER_SET_CLEAR:
+        controller_set = CLEAR
+
+    return Row(note, vol, command, parameter, controller_set, controller_value)
+
+EMPTY_ROW = sht4_values_to_row(CELL_EMPTY)
+
+def iter_nonempty_cells(columns):
+    # Yields (column_idx, row_idx, sht4_values) for every non-empty cell of
+    # one instrument pattern, in column-major order, for any pattern storage.
+    if is_columnar(columns):
+        mask = columnar_nonempty_mask(columns)
+        column_idxs, row_idxs = numpy.nonzero(mask)
+        yield from zip(column_idxs.tolist(), row_idxs.tolist(), columns[mask][list(CELL_FIELDS)].tolist())
+        return
+
+    if isinstance(columns, PatternRuns):
+        for column_idx, runs in enumerate(columns.columns):
+            for run in runs:
+                values = row_to_sht4_values(run.row)
+                for row_idx in range(run.start, run.start + run.length):
+                    yield column_idx, row_idx, values
+        return
+
+    for column_idx, rows in enumerate(columns):
+        for row_idx, row in enumerate(rows):
+            if row._is_empty():
+                # skip empty notes
+                continue
+
+            yield column_idx, row_idx, row_to_sht4_values(row)
+
+
+class Song:
+    @classmethod
+    def load_from_sht2(cls, fobj, storage='rows', lazy=False, max_decoded_patterns=None, patterns=True):
+        # storage picks how each instrument pattern in song.rows is held:
+        # 'rows' is lists of Rows, 'columnar' a numpy array (see
+        # decode_pattern_data_columnar) and 'runs' a PatternRuns.
+        #
+        # lazy=True only indexes the pattern blocks; each one is decoded when
+        # song.rows[instrument_idx][pattern_idx] is first accessed, keeping at
+        # most max_decoded_patterns of them around. The file stays mapped
+        # until song.close() (or the end of a with block on the song).
+        #
+        # patterns=False skips over the pattern data altogether, leaving each
+        # instrument's list of patterns empty.
+        decode = pattern_decoder(storage)
+
+        with profile_stage('load_sht2'):
+            if not patterns:
+                with open_reader(fobj) as reader:
+                    return cls._load_from_sht2_reader(reader, skip_pattern_blocks)
+
+            if lazy:
+                buffer, start = map_fobj(fobj)
+                cache = PatternBlockCache(buffer, decode, max_decoded_patterns)
+                reader = BufferReader(buffer, start)
+                try:
+                    return cls._load_from_sht2_reader(reader, cache.index_patterns)
+                except BaseException:
+                    cache.close()
+                    raise
+                finally:
+                    reader.release()
+
+            interner = InternTable()
+
+            def load_patterns(reader, num_columns, pattern_metrics):
+                return [decode(reader, num_columns, metrics.length, interner) for metrics in pattern_metrics]
+
+            with open_reader(fobj) as reader:
+                return cls._load_from_sht2_reader(reader, load_patterns)
+
+    @classmethod
+    def _load_from_sht2_reader(cls, reader, load_patterns):
+        if reader.read_c_string(10) != 'SHKT-SONG':
+            raise Exception('Missing SHKT-SONG signature')
+
+        song = Song()
+
+        # import pdb; pdb.set_trace()
+
+        version = reader.read_word_le() # guessed meaning
+
+        song.author = reader.read_pascal_string() # guessed meaning
+        song.name = reader.read_pascal_string() # guessed meaning
+
+        song.tempo = reader.read_byte()
+        song.speed = reader.read_byte()
+
+        #
+        # - pattern metrics -
+        #
+
+        pattern_count = reader.read_word_le()
+
+        pattern_metrics = []
+
+        for pattern_idx in range(pattern_count):
+
+            length = reader.read_word_le()
+            hlminor = reader.read_word_le()
+            hlmajor = reader.read_word_le()
+
+            pattern_metrics.append(PatternMetrics(length, hlmajor, hlminor))
+
+        song.pattern_metrics = pattern_metrics
+
+        #
+        # - orders -
+        #
+
+        order_count = reader.read_word_le()
+
+        order_list = []
+
+        for order_idx in range(order_count):
+            pattern_idx = reader.read_word_le() - 5 # 4 => no order, 5 => pattern 0, 6 => pattern 1, ... // never saw values < 3
+            if pattern_idx < 0:
+                order_list.append(None)
+            else:
+                order_list.append(pattern_idx)
+
+        song.order_list = order_list
+
+        #
+        # - instruments (and pattern data) -
+        #
+
+        instrument_count = reader.read_word_le()
+        instruments = []
+        rows = []
+
+        for instrument_idx in range(instrument_count):
+            name = reader.read_pascal_string()
+            device = reader.read_byte()
+            bank = reader.read_byte()
+            patch = reader.read_byte()
+            channel = reader.read_byte()
+            pbs = reader.read_byte()
+            reader.read_byte() # ?
+            default_volume = reader.read_byte()
+            global_volume = reader.read_byte()
+            reader.read_byte() # ?
+            reader.read_byte() # ?
+            reader.read_byte() # ?
+
+            reader.skip(128) # initial values? don't care
+            reader.skip(130) # don't care
+
+            width = reader.read_byte()
+
+            instruments.append(Instrument(name, width, device, bank, patch, channel, pbs, default_volume, global_volume))
+
+            #
+            # load pattern data
+            #
+
+            with profile_stage('load_sht2.patterns'):
+                rows.append(load_patterns(reader, width, song.pattern_metrics))
+
+        song.instruments = instruments
+        song.rows = rows
+
+        return song
+
+    @classmethod
+    def load_from_sht4(cls, fobj, storage='rows', patterns=True):
+        # patterns=False reads the pattern metrics but skips over the notes,
+        # leaving each instrument's list of patterns empty
+        pattern_decoder(storage) # validates storage
+
+        # Each PATTERN n DATA section's notes are set aside as compact note
+        # records as it's read (see PatternNoteRecords), so the note_N
+        # properties of the whole file are never held at once
+        sections = OrderedDict()
+        pattern_notes = {}
+
+        # closed here rather than whenever it's collected, which could be after
+        # fobj is closed if add() raises
+        with closing(Properties.iter_sections(fobj, SHT4_HEADER, property_filter=None if patterns else is_not_note_property)) as section_iter:
+            for section_name, properties in section_iter:
+                if patterns and section_name.startswith('PATTERN '):
+                    pattern_notes.setdefault(section_name, PatternNoteRecords()).add(section_name, properties)
+                    properties = properties.filtered(is_not_note_property)
+
+                section = sections.setdefault(section_name, properties)
+                if section is not properties:
+                    # repeated section; merge like Properties.load_from_fobj
+                    for property_name, property_value in properties.items_bytes():
+                        section.setdefault_bytes(property_name, property_value)
+
+        def get_section(section_name):
+            section = sections.get(section_name)
+            if section is None:
+                raise Exception(f'Missing {section_name} section')
+            return section
+
+        song = Song()
+
+        info = sections.get('INFO', {})
+        song.name = info.get('name', '')
+        song.author = info.get('author', '')
+
+        speed = sections.get('SPEED', {})
+        song.speed = int(speed.get('rpq', song.speed))
+        song.tempo = int(speed.get('tempo', song.tempo))
+
+        #
+        # TRACKS
+        #
+
+        instruments = []
+
+        for instrument_idx in range(int(get_section('TRACKS')['amount'])):
+            section = get_section(f'TRACK {instrument_idx} INFO')
+            instruments.append(Instrument(
+                section.get('name', ''),
+                int(section.get('width', 1)),
+                int(section.get('midi_device', 0)),
+                int(section.get('midi_bank', 0)),
+                int(section.get('midi_patch', 0)),
+                int(section.get('midi_channel', 0)),
+                int(section.get('midi_pitch_bend_sensitivity', 0)),
+                int(section.get('default_volume', 64)),
+                int(section.get('global_volume', 127)),
+            ))
+
+        song.instruments = instruments
+
+        #
+        # ORDER LIST
+        #
+
+        section = get_section('ORDER LIST')
+        order_list = []
+
+        for order_idx in range(int(section.get('max_order', 0))):
+            order = int(section[f'order_{order_idx}'])
+            order_list.append(None if order < 0 else order)
+
+        song.order_list = order_list
+
+        #
+        # PATTERNS
+        #
+
+        # sht4 patterns hold every instrument's columns side by side
+        column_owners = []
+        for instrument_idx, instrument in enumerate(instruments):
+            for column_idx in range(instrument.track_width):
+                column_owners.append((instrument_idx, column_idx))
+
+        pattern_metrics = []
+        rows = [[] for instrument in instruments]
+        interner = InternTable()
+
+        for pattern_idx in range(int(get_section('PATTERNS')['amount'])):
+            section = get_section(f'PATTERN {pattern_idx} DATA')
+
+            metrics = PatternMetrics(int(section['length']), int(section.get('hl_major', 16)), int(section.get('hl_minor', 4)))
+            pattern_metrics.append(metrics)
+
+            if not patterns:
+                continue
+
+            notes = pattern_notes.get(f'PATTERN {pattern_idx} DATA')
+            note_records = notes.records() if notes is not None else b''
+
+            if storage == 'columnar':
+                for instrument_idx, instrument in enumerate(instruments):
+                    rows[instrument_idx].append(numpy.array([[CELL_EMPTY_FLAGGED] * metrics.length] * instrument.track_width, dtype=CELL_DTYPE))
+                place_note_records_columnar(note_records, rows, pattern_idx, column_owners, metrics.length)
+            elif storage == 'runs':
+                # straight from the note records, without expanding the rows
+                runs_columns = note_record_runs(note_records, column_owners, metrics.length, interner)
+                column_offset = 0
+                for instrument_idx, instrument in enumerate(instruments):
+                    rows[instrument_idx].append(PatternRuns(metrics.length, runs_columns[column_offset:column_offset + instrument.track_width]))
+                    column_offset += instrument.track_width
+            else:
+                for instrument_idx, instrument in enumerate(instruments):
+                    rows[instrument_idx].append([[EMPTY_ROW] * metrics.length for column_idx in range(instrument.track_width)])
+                place_note_records(note_records, rows, pattern_idx, column_owners, metrics.length, interner)
+
+                for instrument_rows in rows:
+                    instrument_rows[pattern_idx] = [interner.column(tuple(column)) for column in instrument_rows[pattern_idx]]
+
+        song.pattern_metrics = pattern_metrics
+        song.rows = rows
+
+        return song
+
+
+    def __init__(self):
+        self.name = ''
+        self.author = ''
+
+        self.speed = 1 # typ 4
+        self.tempo = 1 # typ 150
+
+        self.pattern_metrics = []
+        self.order_list = []
+        self.instruments = []
+        self.rows = [] # rows[instrument_idx][pattern_idx][column_idx][row_idx], or a CELL_DTYPE array / PatternRuns per [instrument_idx][pattern_idx]
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # Releases the file mapped by load_from_sht2(lazy=True); a no-op for
+        # songs loaded any other way
+        for instrument_patterns in self.rows:
+            if isinstance(instrument_patterns, LazyPatterns):
+                instrument_patterns.close()
+
+    def save_to_file(self, filename):
+        with open(filename, 'wb', buffering=SAVE_BUFFER_SIZE) as fobj:
+            self.save_to_fobj(fobj)
+
+    def save_to_sht2(self, fobj, encode_pattern=encode_pattern_data):
+        # Writes the layout load_from_sht2 reads (see TECHNICAL.txt), with
+        # the values this tool doesn't know the meaning of filled in as they
+        # appear in real files. encode_pattern(columns) returns each
+        # instrument pattern's block.
+        with profile_stage('save_sht2'):
+            writer = FileWriter(fobj)
+
+            fobj.write(b'SHKT-SONG\x00')
+            fobj.write(struct.pack('<H', SHT2_VERSION))
+            writer.store_pascal_string(self.author)
+            writer.store_pascal_string(self.name)
+            writer.store_byte(self.tempo)
+            writer.store_byte(self.speed)
+
+            fobj.write(struct.pack('<H', len(self.pattern_metrics)))
+            for metrics in self.pattern_metrics:
+                fobj.write(struct.pack('<HHH', metrics.length, metrics.highlight_minor, metrics.highlight_major))
+
+            # 0.2.x files always have 500 orders, unused ones being ---
+            order_list = self.order_list + [None] * (SHT2_ORDER_COUNT - len(self.order_list))
+            fobj.write(struct.pack('<H', len(order_list)))
+            fobj.write(b''.join(struct.pack('<H', 4 if order is None else order + 5) for order in order_list))
+
+            fobj.write(struct.pack('<H', len(self.instruments)))
+            for instrument, instrument_patterns in zip(self.instruments, self.rows):
+                writer.store_pascal_string(instrument.name)
+                fobj.write(bytes((instrument.device, instrument.bank, instrument.patch, instrument.channel, instrument.pitch_bend_sensitivity, 0,
+                                  instrument.default_volume, instrument.global_volume, 0, 11, 0)))
+                fobj.write(b'\xff' * 128) # initial controller values: none
+                fobj.write(bytes(130))
+                writer.store_byte(instrument.track_width)
+
+                with profile_stage('save_sht2.patterns'):
+                    for columns in instrument_patterns:
+                        fobj.write(encode_pattern(columns))
+
+            fobj.write(b'\x02\x00SHKT-INST')
+
+    def save_to_fobj(self, fobj, write_pattern_section=None):
+        # write_pattern_section(props, pattern_idx), if given, writes each
+        # PATTERN n DATA section in place of self.write_pattern_section.
+        # Otherwise the patterns share a note record cache (see
+        # column_note_records_raw) that's dropped when the save is done. A
+        # lazily loaded song gets none: its blocks are decoded afresh each
+        # time, so the cache would never hit and would keep them all alive.
+        if write_pattern_section is None:
+            if any(isinstance(instrument_patterns, LazyPatterns) for instrument_patterns in self.rows):
+                note_record_cache = None
+            else:
+                note_record_cache = OrderedDict()
+
+            def write_pattern_section(props, pattern_idx):
+                self.write_pattern_section(props, pattern_idx, note_record_cache)
+
+        with profile_stage('save_sht4'):
+            self._save_to_fobj(fobj, write_pattern_section)
+
+    def _save_to_fobj(self, fobj, write_pattern_section):
+        props = PropertiesWriter(fobj, SHT4_HEADER)
+
+        section = props.add_section('VERSION')
+        section.add_property('version', '0.3.99') # my files are tagged 0.3.9, but shaketracker 0.4.x ignores this property on load anyway
+
+        section = props.add_section('INFO')
+        section.add_property('name', self.name)
+        section.add_property('author', self.author)
+
+        section = props.add_section('SPEED')
+        section.add_property('rpq', self.speed)
+        section.add_property('tempo', self.tempo)
+
+        #
+        # TRACKS
+        #
+
+        section = props.add_section('TRACKS')
+        section.add_property('amount', len(self.instruments))
+
+        for instrument_idx, instrument in enumerate(self.instruments):
+            section = props.add_section(f'TRACK {instrument_idx} INFO')
+
+            section.add_property('default_volume', instrument.default_volume)
+            section.add_property('global_volume', instrument.global_volume)
+            section.add_property('midi_bank', instrument.bank)
+            section.add_property('midi_channel', instrument.channel)
+            section.add_property('midi_device', instrument.device)
+            section.add_property('midi_patch', instrument.patch)
+            section.add_property('midi_pitch_bend_sensitivity', instrument.pitch_bend_sensitivity)
+            section.add_property('name', instrument.name)
+            section.add_property('width', instrument.track_width)
+
+            # constants copied from a new file
+            section.add_property('PNVA_controller', 11)
+            section.add_property('PNVA_type', 3)
+            section.add_property('initial_values', 5)
+            section.add_property('initial_value_0_number', 7)
+            section.add_property('initial_value_0_type', 0)
+            section.add_property('initial_value_0_value', 127)
+            section.add_property('initial_value_1_number', 10)
+            section.add_property('initial_value_1_type', 0)
+            section.add_property('initial_value_1_value', 64)
+            section.add_property('initial_value_2_number', 91)
+            section.add_property('initial_value_2_type', 0)
+            section.add_property('initial_value_2_value', 24)
+            section.add_property('initial_value_3_number', 94)
+            section.add_property('initial_value_3_type', 0)
+            section.add_property('initial_value_3_value', 10)
+            section.add_property('initial_value_4_number', 11)
+            section.add_property('initial_value_4_type', 0)
+            section.add_property('initial_value_4_value', 127)
+            section.add_property('mute', 0)
+
+
+        #
+        # ORDER LIST
+        #
+
+        section = props.add_section('ORDER LIST')
+
+        # TODO: When we include all 500 orders in the output, shaketracker
+        # 0.4.6 sets song->pattern_data[i].rowlength to -1 for all patterns.
+        # (Why does this happen??? It seems to be caused by unrelated code
+        # that resizes the order list. Memory corruption maybe?)
+        #
+        # That causes a crash if the first pattern's length is less than the
+        # number of patterns, which happens when the pattern length is 48
+        # (a somewhat uncommon value, typical is 64) and there are 50 patterns
+        # (typical number) because 48 + (-1 * 50) < 0, and then an STL resize()
+        # call fails.
+        #
+        # So we limit orders to 200, which is really enough, and that's the
+        # normal maximum for shaketracker 0.4.6 anyway.
+        order_list = self.order_list[:200]
+
+        section.add_property('max_order', len(order_list))
+        for order_idx, order in enumerate(order_list):
+            if order is None:
+                order_value = -1
+            else:
+                order_value = order
+            section.add_property(f'order_{order_idx}', order_value)
+
+        #
+        # PATTERNS
+        #
+
+        section = props.add_section('PATTERNS')
+        section.add_property('amount', len(self.pattern_metrics))
+
+        for pattern_idx in range(len(self.pattern_metrics)):
+            write_pattern_section(props, pattern_idx)
+
+
+
+
+        #
+        # DEVICES
+        #
+
+        section = props.add_section('DEVICES')
+        section.add_property('amount', 1)
+
+        props.write_raw(_standard_device_properties_raw)
+
+    def write_pattern_section(self, props, pattern_idx, note_record_cache=None):
+        pattern_metrics = self.pattern_metrics[pattern_idx]
+
+        section = props.add_section(f'PATTERN {pattern_idx} DATA')
+        section.add_property('length', pattern_metrics.length)
+        section.add_property('hl_major', pattern_metrics.highlight_major)
+        section.add_property('hl_minor', pattern_metrics.highlight_minor)
+
+        pattern_column_offset = 0
+        pattern_note_count = 0
+
+        for instrument_idx, instrument_patterns in enumerate(self.rows):
+            instrument_pattern_columns = instrument_patterns[pattern_idx]
+
+            with profile_stage('save_sht4.encode_notes'):
+                note_records = encode_pattern_note_records(instrument_pattern_columns, pattern_column_offset, note_record_cache)
+
+            with profile_stage('save_sht4.write_notes'):
+                for note_record in note_records:
+                    section.add_property(f'note_{pattern_note_count}', note_record)
+                    pattern_note_count += 1
+
+            pattern_column_offset += len(instrument_pattern_columns)
+
+        section.add_property('note_count', pattern_note_count)
+
+
+# implements get_str_from_char
+def sht4_byte_to_bytestring(b):
+    return bytes([ord(b'A') + ((b >> 4) & 0xf),
+                  ord(b'A') + (b & 0xf)])
+
+def sht4_bytestring_to_byte(bs):
+    return ((ord(bs[0]) - ord(b'A')) << 4) | (ord(bs[1]) - ord(b'A'))
+
+#
+# Bulk versions of the above, for note records. A note record is 8 bytes
+# (note, vol, command, parameter, controller_set, controller_value, column,
+# row), each encoded as 2 characters. Encoding splits every byte into two
+# nibble characters with bytes.translate and interleaves them; decoding does
+# the reverse, combining the nibbles as two big integers. Either way there's
+# no per-byte Python work.
+#
+
+SHT4_NOTE_RECORD_BYTES = 8
+
+_sht4_high_nibble_chars = bytes(ord(b'A') + (b >> 4) for b in range(256))
+_sht4_low_nibble_chars = bytes(ord(b'A') + (b & 0xf) for b in range(256))
+_sht4_high_nibble_values = bytes(((c - ord(b'A')) & 0xf) << 4 for c in range(256))
+_sht4_low_nibble_values = bytes((c - ord(b'A')) & 0xf for c in range(256))
+
+def sht4_encode_note_records(raw):
+    # raw: bytes-like, SHT4_NOTE_RECORD_BYTES per record. Returns a list of
+    # note record strs.
+    encoded = bytearray(len(raw) * 2)
+    encoded[0::2] = raw.translate(_sht4_high_nibble_chars)
+    encoded[1::2] = raw.translate(_sht4_low_nibble_chars)
+    encoded = encoded.decode('ascii')
+
+    record_length = SHT4_NOTE_RECORD_BYTES * 2
+    return [encoded[i:i + record_length] for i in range(0, len(encoded), record_length)]
+
+def sht4_decode_note_records(note_records):
+    # Inverse of sht4_encode_note_records: takes an iterable of note records
+    # (as strs or ascii bytes) and returns the raw bytes,
+    # SHT4_NOTE_RECORD_BYTES per record.
+    encoded = b''.join(note_record.encode('ascii') if isinstance(note_record, str) else note_record for note_record in note_records)
+
+    high = encoded[0::2].translate(_sht4_high_nibble_values)
+    low = encoded[1::2].translate(_sht4_low_nibble_values)
+
+    return (int.from_bytes(high, 'big') | int.from_bytes(low, 'big')).to_bytes(len(high), 'big')
+
+def encode_pattern_note_records(columns, column_offset, note_record_cache=None):
+    # Returns note record strs for the non-empty cells of one instrument
+    # pattern, whose first column is column_offset within the sht4 pattern.
+    # note_record_cache is passed on to column_note_records_raw.
+    if is_columnar(columns):
+        mask = columnar_nonempty_mask(columns)
+        column_idxs, row_idxs = numpy.nonzero(mask)
+        cells = columns[mask]
+
+        raw = numpy.empty((len(cells), SHT4_NOTE_RECORD_BYTES), dtype=numpy.uint8)
+        for field_idx, field in enumerate(CELL_FIELDS):
+            raw[:, field_idx] = cells[field]
+        raw[:, 6] = (column_idxs + column_offset) & 0xff
+        raw[:, 7] = row_idxs & 0xff
+
+        num_cells = count_pattern_cells(columns)
+        raw = raw.tobytes()
+        note_records = sht4_encode_note_records(raw)
+    else:
+        num_cells = 0
+        raw = bytearray()
+
+        if isinstance(columns, PatternRuns):
+            for column_idx, runs in enumerate(columns.columns):
+                raw += column_note_records_raw(runs, column_offset + column_idx, True, note_record_cache)
+        else:
+            for column_idx, rows in enumerate(columns):
+                raw += column_note_records_raw(rows, column_offset + column_idx, False, note_record_cache)
+
+        if _active_profile is not None:
+            num_cells = count_pattern_cells(columns)
+
+        note_records = sht4_encode_note_records(raw)
+
+    if _active_profile is not None:
+        _active_profile.count('note_records_emitted', len(note_records))
+        _active_profile.count('empty_cells_skipped', num_cells - len(note_records))
+
+    return note_records
+
+# Columns kept by the note record cache of one save (see
+# column_note_records_raw)
+NOTE_RECORD_CACHE_SIZE = 4096
+
+def column_note_records_raw(column, column_number, is_runs, note_record_cache=None):
+    # Returns the raw note records (see sht4_encode_note_records) for one
+    # column of Rows, or of Runs if is_runs.
+    #
+    # note_record_cache, if given, is an OrderedDict of the most recently
+    # used NOTE_RECORD_CACHE_SIZE columns that turn up more than once in a
+    # song (they're interned, see InternTable), keyed by the column's id and
+    # its column number. Each entry holds on to its column, so the id can't
+    # be reused by another column while the entry exists. Only tuples are
+    # cached; a list could change after it's been encoded.
+    cacheable = note_record_cache is not None and isinstance(column, tuple)
+    if cacheable:
+        key = (id(column), column_number)
+        cached = note_record_cache.get(key)
+        if cached is not None:
+            note_record_cache.move_to_end(key)
+            profile_count('note_record_cache_hits')
+            return cached[1]
+
+    raw = bytearray()
+    column_byte = column_number & 0xff
+
+    if is_runs:
+        for run in column:
+            values = bytes(row_to_sht4_values(run.row))
+            for row_idx in range(run.start, run.start + run.length):
+                raw += values
+                raw.append(column_byte)
+                raw.append(row_idx & 0xff)
+    else:
+        for row_idx, row in enumerate(column):
+            if row._is_empty():
+                # skip empty notes
+                continue
+
+            raw.extend(row_to_sht4_values(row))
+            raw.append(column_byte)
+            raw.append(row_idx & 0xff)
+
+    if cacheable:
+        raw = bytes(raw)
+        note_record_cache[key] = (column, raw)
+        if len(note_record_cache) > NOTE_RECORD_CACHE_SIZE:
+            note_record_cache.popitem(last=False)
+
+    return raw
+
+def is_not_note_property(property_name):
+    # property_filter for reading sht4 files without their notes
+    return not property_name.startswith('note_')
+
+class PatternNoteRecords:
+    # The note_N properties of a PATTERN n DATA section, as raw note records
+    # (see sht4_decode_note_records) and their Ns: a tenth of the memory of
+    # the properties themselves. add() is called once per appearance of the
+    # section; as when Properties merges a repeated section, the first value
+    # for each N wins.
+
+    __slots__ = ('_numbers', '_records')
+
+    def __init__(self):
+        self._numbers = array('I')
+        self._records = bytearray()
+
+    def add(self, section_name, section):
+        numbers = []
+        values = []
+
+        # the records are decoded all at once, so one of the wrong length
+        # would shift every record after it
+        record_length = SHT4_NOTE_RECORD_BYTES * 2
+
+        seen = set(self._numbers) if self._numbers else ()
+        for property_name, property_value in section.items_bytes():
+            if property_name.startswith('note_') and property_name != 'note_count':
+                if len(property_value) != record_length:
+                    raise Exception(f'{section_name} {property_name} is {len(property_value)} characters long, expected {record_length}')
+
+                note_idx = int(property_name[5:])
+                if note_idx not in seen:
+                    numbers.append(note_idx)
+                    values.append(property_value)
+
+        self._numbers.extend(numbers)
+        self._records += sht4_decode_note_records(values)
+
+    def records(self):
+        # in N order
+        numbers = self._numbers
+        if all(numbers[idx] < numbers[idx + 1] for idx in range(len(numbers) - 1)):
+            return bytes(self._records)
+
+        record_length = SHT4_NOTE_RECORD_BYTES
+        return b''.join(self._records[idx * record_length:(idx + 1) * record_length] for idx in sorted(range(len(numbers)), key=numbers.__getitem__))
+
+def _check_note_record_position(column, row, column_owners, num_rows):
+    if column >= len(column_owners) or row >= num_rows:
+        raise Exception(f'Note at column {column}, row {row} is outside the pattern ({len(column_owners)} columns, {num_rows} rows)')
+
+def place_note_records(note_records, rows, pattern_idx, column_owners, num_rows, interner):
+    # Stores raw note records (as returned by sht4_decode_note_records) as
+    # Rows, interned in interner, in rows[instrument_idx][pattern_idx]
+    record_length = SHT4_NOTE_RECORD_BYTES
+
+    for record_offset in range(0, len(note_records), record_length):
+        record = note_records[record_offset:record_offset + record_length]
+        column, row = record[6], record[7]
+        _check_note_record_position(column, row, column_owners, num_rows)
+
+        instrument_idx, column_idx = column_owners[column]
+        rows[instrument_idx][pattern_idx][column_idx][row] = interner.row_from_values(record[:6], sht4_values_to_row)
+
+def note_record_runs(note_records, column_owners, num_rows, interner):
+    # Returns a tuple of Runs (see PatternRuns) for each column of a sht4
+    # pattern, from its raw note records. Only the records are held, not
+    # every row; as with place_note_records, a later record for the same
+    # cell replaces an earlier one.
+    record_length = SHT4_NOTE_RECORD_BYTES
+    column_cells = [{} for column in column_owners]
+
+    for record_offset in range(0, len(note_records), record_length):
+        record = note_records[record_offset:record_offset + record_length]
+        column, row = record[6], record[7]
+        _check_note_record_position(column, row, column_owners, num_rows)
+
+        column_cells[column][row] = interner.row_from_values(record[:6], sht4_values_to_row)
+
+    columns = []
+
+    for cells in column_cells:
+        runs = []
+        for row_idx in sorted(cells):
+            row = cells[row_idx]
+            if row._is_empty():
+                continue
+
+            if runs and runs[-1].row == row and runs[-1].start + runs[-1].length == row_idx:
+                runs[-1] = runs[-1]._replace(length=runs[-1].length + 1)
+            else:
+                runs.append(Run(row, row_idx, 1))
+        columns.append(interner.column(tuple(runs)))
+
+    return columns
+
+def place_note_records_columnar(note_records, rows, pattern_idx, column_owners, num_rows):
+    records = numpy.frombuffer(note_records, dtype=numpy.uint8).reshape(-1, SHT4_NOTE_RECORD_BYTES)
+    if not len(records):
+        return
+
+    _check_note_record_position(int(records[:, 6].max()), int(records[:, 7].max()), column_owners, num_rows)
+
+    owners = numpy.array(column_owners, dtype=numpy.int64).reshape(-1, 2)[records[:, 6]]
+
+    for instrument_idx in numpy.unique(owners[:, 0]).tolist():
+        selected = owners[:, 0] == instrument_idx
+        cells = rows[instrument_idx][pattern_idx]
+        column_idxs = owners[selected, 1]
+        row_idxs = records[selected, 7]
+
+        for field_idx, field in enumerate(CELL_FIELDS):
+            cells[field][column_idxs, row_idxs] = records[selected, field_idx]
+        cells['command_set'][column_idxs, row_idxs] = records[selected, 2] != CELL_COMMAND_CLEAR
+
+def print_interesting_sht4_bytestrings():
+    print('0 = ' + sht4_byte_to_bytestring(0))
+    print('64 = ' + sht4_byte_to_bytestring(64))
+    print('65 = ' + sht4_byte_to_bytestring(65))
+    print('CUT(253) = ' + sht4_byte_to_bytestring(253))
+    print('OFF(254) = ' + sht4_byte_to_bytestring(254))
+    print('CLEAR(255) = ' + sht4_byte_to_bytestring(255))
+
+# Bump this whenever a change to conversion changes its output, so cached
+# results from older versions aren't reused.
+CONVERTER_FORMAT_VERSION = 1
+
+def parse_size(text):
+    # eg. '500M' => 524288000
+    suffixes = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in suffixes:
+        return int(float(text[:-1]) * suffixes[text[-1]])
+
+    return int(text)
+
+def _replace_with_copy(source_filename, destination_filename, link=False):
+    # Puts a copy (or hardlink) of source at destination atomically, so
+    # readers never see a partial file
+    import shutil
+
+    temp_filename = f'{destination_filename}.{os.getpid()}.tmp'
+    try:
+        if link:
+            os.link(source_filename, temp_filename)
+        else:
+            shutil.copyfile(source_filename, temp_filename)
+        os.replace(temp_filename, destination_filename)
+    except BaseException:
+        try:
+            os.unlink(temp_filename)
+        except FileNotFoundError:
+            pass
+        raise
+
+class ConversionCache:
+    # Content-addressed store of converted files, keyed by a hash of the
+    # input bytes and CONVERTER_FORMAT_VERSION. Entries are only ever created
+    # by atomic rename, so any number of processes can share a cache
+    # directory. Each hit refreshes the entry's mtime, and prune() evicts the
+    # least recently used entries until the cache fits in max_size.
+
+    DEFAULT_MAX_SIZE = 1 << 30
+    ENTRY_SUFFIX = '.sht4'
+    HASH_CHUNK_SIZE = 1 << 20
+    STALE_TEMP_SECONDS = 3600
+
+    @staticmethod
+    def default_directory():
+        return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'shaketrackertool')
+
+    def __init__(self, directory=None, max_size=None, link=False):
+        self.directory = directory or ConversionCache.default_directory()
+        self.max_size = ConversionCache.DEFAULT_MAX_SIZE if max_size is None else max_size
+        self.link = link
+        # entries added by this instance, so callers can skip prune() when
+        # nothing has grown the cache
+        self.stored = 0
+
+    def key(self, input_filename):
+        import hashlib
+
+        digest = hashlib.sha256(f'shaketrackertool {CONVERTER_FORMAT_VERSION}\n'.encode('ascii'))
+
+        with open(input_filename, 'rb') as fobj:
+            for chunk in iter(lambda: fobj.read(ConversionCache.HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def entry_filename(self, key):
+        return os.path.join(self.directory, key[:2], key + ConversionCache.ENTRY_SUFFIX)
+
+    def fetch(self, key, output_filename):
+        # Returns True if output_filename now holds the cached result
+        entry_filename = self.entry_filename(key)
+
+        try:
+            os.utime(entry_filename)
+            _replace_with_copy(entry_filename, output_filename, self.link)
+        except FileNotFoundError:
+            # not cached, or evicted by someone else just now
+            return False
+        except OSError:
+            if not self.link:
+                raise
+            # eg. the cache is on a different filesystem; fall back to copying
+            _replace_with_copy(entry_filename, output_filename)
+
+        return True
+
+    def store(self, key, converted_filename):
+        import shutil
+        import tempfile
+
+        entry_filename = self.entry_filename(key)
+        os.makedirs(os.path.dirname(entry_filename), exist_ok=True)
+
+        temp_fd, temp_filename = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(entry_filename))
+        try:
+            with os.fdopen(temp_fd, 'wb') as temp_fobj, open(converted_filename, 'rb') as fobj:
+                shutil.copyfileobj(fobj, temp_fobj)
+            os.replace(temp_filename, entry_filename)
+        except BaseException:
+            try:
+                os.unlink(temp_filename)
+            except FileNotFoundError:
+                pass
+            raise
+
+        self.stored += 1
+
+    def entries(self):
+        # [(mtime, size, filename), ...], oldest first
+        entries = []
+
+        if not os.path.isdir(self.directory):
+            return entries
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(ConversionCache.ENTRY_SUFFIX):
+                    continue
+
+                entry_filename = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(entry_filename)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_filename))
+
+        entries.sort()
+        return entries
+
+    def stats(self):
+        entries = self.entries()
+        return OrderedDict((
+            ('directory', self.directory),
+            ('entries', len(entries)),
+            ('total_bytes', sum(size for mtime, size, entry_filename in entries)),
+            ('max_bytes', self.max_size),
+            ('format_version', CONVERTER_FORMAT_VERSION),
+        ))
+
+    def prune(self, max_size=None):
+        # Returns (entries removed, bytes removed)
+        max_size = self.max_size if max_size is None else max_size
+
+        entries = self.entries()
+        total_size = sum(size for mtime, size, entry_filename in entries)
+
+        removed_count = 0
+        removed_size = 0
+
+        for mtime, size, entry_filename in entries:
+            if total_size <= max_size:
+                break
+
+            try:
+                os.unlink(entry_filename)
+                removed_count += 1
+                removed_size += size
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+        self._remove_stale_temp_files()
+
+        return removed_count, removed_size
+
+    def _remove_stale_temp_files(self):
+        # left behind by processes that died mid-store
+        cutoff = time.time() - ConversionCache.STALE_TEMP_SECONDS
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    temp_filename = os.path.join(dirpath, filename)
+                    try:
+                        if os.stat(temp_filename).st_mtime < cutoff:
+                            os.unlink(temp_filename)
+                    except FileNotFoundError:
+                        pass
+
+CONVERSION_MANIFEST_SUFFIX = '.manifest'
+
+def sht2_pattern_digests(song):
+    # For a song loaded with lazy=True, returns one digest per pattern
+    # covering everything its PATTERN n DATA section is encoded from: the
+    # pattern metrics, and each instrument's width and raw pattern block
+    # (length prefix included).
+    import hashlib
+
+    digests = []
+
+    for pattern_idx, metrics in enumerate(song.pattern_metrics):
+        digest = hashlib.sha256(f'shaketrackertool {CONVERTER_FORMAT_VERSION} {tuple(metrics)}\n'.encode('ascii'))
+
+        for instrument_patterns in song.rows:
+            block = instrument_patterns.blocks[pattern_idx]
+            digest.update(struct.pack('<II', block.num_columns, block.length))
+            digest.update(instrument_patterns.cache.buffer[block.offset:block.offset + 4 + block.length])
+
+        digests.append(digest.hexdigest())
+
+    return digests
+
+def load_conversion_manifest(output_filename):
+    # Returns [(digest, offset, length), ...] for each PATTERN n DATA section
+    # of output_filename, or None if it has no manifest or has changed since
+    # the manifest was written
+    import json
+
+    try:
+        with open(output_filename + CONVERSION_MANIFEST_SUFFIX) as fobj:
+            manifest = json.load(fobj)
+        stat = os.stat(output_filename)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if (not isinstance(manifest, dict)
+            or manifest.get('version') != CONVERTER_FORMAT_VERSION
+            or manifest.get('output_size') != stat.st_size
+            or manifest.get('output_mtime_ns') != stat.st_mtime_ns):
+        return None
+
+    return [tuple(section) for section in manifest['patterns']]
+
+def save_conversion_manifest(output_filename, pattern_sections):
+    import json
+
+    stat = os.stat(output_filename)
+    manifest = {
+        'version': CONVERTER_FORMAT_VERSION,
+        'output_size': stat.st_size,
+        'output_mtime_ns': stat.st_mtime_ns,
+        'patterns': pattern_sections,
+    }
+
+    manifest_filename = output_filename + CONVERSION_MANIFEST_SUFFIX
+    temp_filename = f'{manifest_filename}.{os.getpid()}.tmp'
+    try:
+        with open(temp_filename, 'w') as fobj:
+            json.dump(manifest, fobj)
+        os.replace(temp_filename, manifest_filename)
+    except BaseException:
+        try:
+            os.unlink(temp_filename)
+        except FileNotFoundError:
+            pass
+        raise
+
+def remove_conversion_manifest(output_filename):
+    try:
+        os.unlink(output_filename + CONVERSION_MANIFEST_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+def convert2to4_incremental(input_filename, output_filename, storage='runs'):
+    # Converts like convert2to4, but copies each PATTERN n DATA section whose
+    # input blocks are unchanged since the last incremental conversion to
+    # output_filename straight from the old output; only the other patterns
+    # are decoded and encoded. The output is the same as a full conversion.
+    # Returns the number of reused pattern sections.
+    previous_sections = load_conversion_manifest(output_filename)
+
+    with open(input_filename, 'rb') as fobj:
+        song = Song.load_from_sht2(fobj, storage, lazy=True, max_decoded_patterns=1)
+
+    with song:
+        digests = sht2_pattern_digests(song)
+        pattern_sections = []
+        reused_count = 0
+
+        temp_filename = f'{output_filename}.{os.getpid()}.tmp'
+        try:
+            with (open(output_filename, 'rb') if previous_sections is not None else nullcontext()) as previous_fobj, \
+                    open(temp_filename, 'wb', buffering=SAVE_BUFFER_SIZE) as fobj:
+
+                def write_pattern_section(props, pattern_idx):
+                    nonlocal reused_count
+
+                    digest = digests[pattern_idx]
+                    offset = fobj.tell()
+
+                    if previous_sections is not None and pattern_idx < len(previous_sections) and previous_sections[pattern_idx][0] == digest:
+                        previous_digest, previous_offset, previous_length = previous_sections[pattern_idx]
+                        previous_fobj.seek(previous_offset)
+                        props.write_raw(previous_fobj.read(previous_length))
+                        reused_count += 1
+                    else:
+                        song.write_pattern_section(props, pattern_idx)
+
+                    pattern_sections.append((digest, offset, fobj.tell() - offset))
+
+                song.save_to_fobj(fobj, write_pattern_section)
+
+            os.replace(temp_filename, output_filename)
+        except BaseException:
+            try:
+                os.unlink(temp_filename)
+            except FileNotFoundError:
+                pass
+            raise
+
+    save_conversion_manifest(output_filename, pattern_sections)
+
+    profile_count('patterns_reused', reused_count)
+    profile_count('patterns_encoded', len(digests) - reused_count)
+
+    return reused_count
+
+# '-' as an input or output filename means stdin or stdout
+STDIO_FILENAME = '-'
+
+@contextmanager
+def open_input(input_filename):
+    # stdin is read through a large buffer, so parsing a pipe (which can't be
+    # mapped; see open_reader) reads it in big chunks
+    if input_filename == STDIO_FILENAME:
+        with open(sys.stdin.fileno(), 'rb', buffering=READ_BUFFER_SIZE, closefd=False) as fobj:
+            yield fobj
+    else:
+        with open(input_filename, 'rb') as fobj:
+            yield fobj
+
+@contextmanager
+def open_output(output_filename):
+    if output_filename == STDIO_FILENAME:
+        sys.stdout.flush()
+        with open(sys.stdout.fileno(), 'wb', buffering=SAVE_BUFFER_SIZE, closefd=False) as fobj:
+            yield fobj
+    else:
+        with open(output_filename, 'wb', buffering=SAVE_BUFFER_SIZE) as fobj:
+            yield fobj
+
+def _output_exists(output_filename):
+    return output_filename != STDIO_FILENAME and os.path.exists(output_filename)
+
+def _is_stdio(*filenames):
+    return STDIO_FILENAME in filenames
+
+def convert2to4_fobj(input_fobj, output_fobj, storage='runs'):
+    # Converts between any binary streams, pipes included: input_fobj is
+    # read as it's parsed (see open_reader), and the output is written to
+    # output_fobj as it's produced, not collected first
+    song = Song.load_from_sht2(input_fobj, storage)
+    song.save_to_fobj(output_fobj)
+
+def convert2to4(input_filename, output_filename, overwrite_ok=False, storage='runs', cache=None, incremental=False):
+    # cache is an optional ConversionCache; it isn't pruned here (see
+    # ConversionCache.prune). incremental=True converts with
+    # convert2to4_incremental, keeping its manifest next to the output.
+    # Either filename may be STDIO_FILENAME, but not with cache or
+    # incremental.
+    if _output_exists(output_filename) and not overwrite_ok:
+        return False
+
+    if _is_stdio(input_filename, output_filename):
+        if cache is not None or incremental:
+            raise Exception('The conversion cache and incremental conversion need real input and output files')
+
+        with open_input(input_filename) as input_fobj, open_output(output_filename) as output_fobj:
+            convert2to4_fobj(input_fobj, output_fobj, storage)
+        return True
+
+    if cache is not None:
+        key = cache.key(input_filename)
+        if cache.fetch(key, output_filename):
+            profile_count('cache_hits')
+            if incremental:
+                # doesn't describe the cached copy
+                remove_conversion_manifest(output_filename)
+            return True
+        profile_count('cache_misses')
+
+    if incremental:
+        convert2to4_incremental(input_filename, output_filename, storage)
+    else:
+        with open(input_filename, 'rb') as fobj:
+            song = Song.load_from_sht2(fobj, storage)
+        song.save_to_file(output_filename)
+
+    if cache is not None:
+        cache.store(key, output_filename)
+
+    profile_count('bytes_read', os.path.getsize(input_filename))
+    profile_count('bytes_written', os.path.getsize(output_filename))
+
+    return True
+
+def convert4to2_fobj(input_fobj, output_fobj, storage='runs'):
+    # Like convert2to4_fobj. The input is loaded in full before anything is
+    # written.
+    song_format, song = load_song(input_fobj, storage)
+    song.save_to_sht2(output_fobj)
+
+def verify_sht2(song, fobj):
+    # Reads the sht2 data that song.save_to_sht2 wrote to fobj back in, and
+    # raises an exception at the first thing that doesn't match song: every
+    # pattern block has to decode (through decode_pattern_data) to the
+    # song's cells, and the order list has to be padded to SHT2_ORDER_COUNT
+    # with ---
+    written = Song.load_from_sht2(fobj, 'rows')
+
+    for field in ('author', 'name', 'tempo', 'speed', 'pattern_metrics', 'instruments'):
+        if getattr(written, field) != getattr(song, field):
+            raise Exception(f'Verify failed: {field} was written as {getattr(written, field)!r}, not {getattr(song, field)!r}')
+
+    expected_order_list = song.order_list + [None] * (SHT2_ORDER_COUNT - len(song.order_list))
+    if written.order_list != expected_order_list:
+        raise Exception(f'Verify failed: order list was written as {written.order_list!r}, not {expected_order_list!r}')
+
+    for instrument_idx, (instrument_patterns, written_patterns) in enumerate(zip(song.rows, written.rows)):
+        for pattern_idx, (columns, written_columns) in enumerate(zip(instrument_patterns, written_patterns)):
+            for column_idx, (rows, written_rows) in enumerate(zip(pattern_rows(columns), pattern_rows(written_columns))):
+                if rows != written_rows:
+                    row_idx = next(row_idx for row_idx, (row, written_row) in enumerate(zip(rows, written_rows)) if row != written_row)
+                    raise Exception(f'Verify failed: instrument {instrument_idx} pattern {pattern_idx} column {column_idx} row {row_idx} '
+                                    f'was written as {written_rows[row_idx]!r}, not {rows[row_idx]!r}')
+
+def convert4to2(input_filename, output_filename, overwrite_ok=False, storage='runs', verify=False):
+    # input may be sht4, or sht2 (which is then re-encoded as compactly as
+    # possible). Either filename may be STDIO_FILENAME. verify=True reads
+    # the output back in to check it (see verify_sht2); output to stdout is
+    # then held in memory until it's been checked.
+    if _output_exists(output_filename) and not overwrite_ok:
+        return False
+
+    if _is_stdio(input_filename, output_filename):
+        with open_input(input_filename) as input_fobj, open_output(output_filename) as output_fobj:
+            if verify:
+                song_format, song = load_song(input_fobj, storage)
+                output = BytesIO()
+                song.save_to_sht2(output)
+                output.seek(0)
+                with profile_stage('verify'):
+                    verify_sht2(song, output)
+                output_fobj.write(output.getbuffer())
+            else:
+                convert4to2_fobj(input_fobj, output_fobj, storage)
+        return True
+
+    # loaded before the output is opened, so output_filename may be
+    # input_filename
+    with open(input_filename, 'rb') as fobj:
+        song_format, song = load_song(fobj, storage)
+
+    with open(output_filename, 'wb', buffering=SAVE_BUFFER_SIZE) as fobj:
+        song.save_to_sht2(fobj)
+
+    if verify:
+        with profile_stage('verify'), open(output_filename, 'rb') as fobj:
+            verify_sht2(song, fobj)
+
+    profile_count('bytes_read', os.path.getsize(input_filename))
+    profile_count('bytes_written', os.path.getsize(output_filename))
+
+    return True
+
+def _glob_root(input_spec):
+    # the directory part of a file or glob argument, up to its first
+    # wildcard; outputs mirror the input's path relative to this
+    import glob
+
+    parts = []
+    for part in os.path.dirname(input_spec).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+
+    return os.sep.join(parts) or os.curdir
+
+def find_batch_inputs(inputs, pattern='*.sht'):
+    # returns [(input_filename, relative_output_stem), ...] in a stable order,
+    # where relative_output_stem is the input's path relative to the input
+    # argument it came from (a directory, or a glob's directory part)
+    import fnmatch
+    import glob
+
+    found = []
+
+    for input_spec in inputs:
+        if os.path.isdir(input_spec):
+            for dirpath, dirnames, filenames in os.walk(input_spec):
+                dirnames.sort()
+                for filename in sorted(fnmatch.filter(filenames, pattern)):
+                    input_filename = os.path.join(dirpath, filename)
+                    found.append((input_filename, os.path.relpath(input_filename, input_spec)))
+        else:
+            root = _glob_root(input_spec)
+            for input_filename in sorted(glob.glob(input_spec)) or [input_spec]:
+                found.append((input_filename, os.path.relpath(input_filename, root)))
+
+    return found
+
+def _convert_batch_one(input_filename, output_filename, overwrite_ok, storage, cache, incremental):
+    try:
+        os.makedirs(os.path.dirname(output_filename) or '.', exist_ok=True)
+        if convert2to4(input_filename, output_filename, overwrite_ok, storage, cache, incremental):
+            return (input_filename, output_filename, 'converted', None)
+        else:
+            return (input_filename, output_filename, 'skipped', 'output exists')
+    except Exception as e:
+        return (input_filename, output_filename, 'failed', f'{type(e).__name__}: {e}')
+
+def convert2to4_batch(inputs, output_dir, overwrite_ok=False, jobs=None, pattern='*.sht', extension='.sht4', storage='runs', cache=None, incremental=False):
+    from concurrent.futures import ProcessPoolExecutor
+
+    results = []
+    tasks = []
+    output_filenames = set()
+
+    for input_filename, relative_name in find_batch_inputs(inputs, pattern):
+        output_filename = os.path.join(output_dir, os.path.splitext(relative_name)[0] + extension)
+
+        if output_filename in output_filenames:
+            # two inputs would write to the same place; don't let the winner depend on scheduling
+            results.append((input_filename, output_filename, 'failed', 'duplicate output filename'))
+            continue
+
+        output_filenames.add(output_filename)
+        tasks.append((input_filename, output_filename, overwrite_ok, storage, cache, incremental))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_convert_batch_one, *task) for task in tasks]
+        results.extend(future.result() for future in futures)
+
+    results.sort(key=lambda result: result[0])
+
+    if cache is not None:
+        cache.prune()
+
+    return results
+
+def section_glob_filter(patterns):
+    if not patterns:
+        return None
+
+    import fnmatch
+
+    return lambda section_name: any(fnmatch.fnmatchcase(section_name, pattern) for pattern in patterns)
+
+def sorted_sections(sections):
+    return sorted(((section_name, OrderedDict(sorted(properties.items()))) for section_name, properties in sections), key=lambda section: section[0])
+
+def show4(input_filename, output_format='pprint', section_patterns=None, sort=False, output=None):
+    profile_count('bytes_read', os.path.getsize(input_filename))
+
+    with open(input_filename, 'rb') as fobj:
+        show4_fobj(fobj, output_format, section_patterns, sort, output)
+
+def show4_fobj(fobj, output_format='pprint', section_patterns=None, sort=False, output=None):
+    # pprint always sorts (as it always has); json and ndjson stream sections
+    # in file order straight from the input, unless sort is requested
+    section_filter = section_glob_filter(section_patterns)
+    output = output or sys.stdout
+
+    if output_format == 'pprint':
+        from pprint import pprint as pp
+
+        props = Properties.load_from_fobj(fobj, section_filter=section_filter)
+
+        props.sort()
+
+        pp(props.to_ordered_dict(), stream=output)
+        return
+
+    # The section generator is closed before returning, even if writing
+    # stopped early (eg. a closed pipe); left to the garbage collector, it
+    # would try to reposition fobj after show4 has closed it.
+    with closing(Properties.iter_sections(fobj, section_filter=section_filter)) as sections:
+        if sort:
+            sections = sorted_sections(sections)
+
+        write_sections(sections, output_format, output)
+
+def write_sections(sections, output_format='ndjson', output=None):
+    # Writes (section_name, properties) pairs as json or ndjson, in the order
+    # given, as they're produced; or as pprint, sorted
+    output = output or sys.stdout
+
+    if output_format == 'pprint':
+        from pprint import pprint as pp
+
+        pp(OrderedDict(sorted_sections(sections)), stream=output)
+        return
+
+    import json
+
+    if output_format == 'ndjson':
+        for section_name, properties in sections:
+            output.write(json.dumps({'section': section_name, 'properties': dict(properties)}) + '\n')
+
+    elif output_format == 'json':
+        # written incrementally; a section repeated in the file is
+        # repeated here too, rather than merged
+        separator = ''
+        output.write('{')
+        for section_name, properties in sections:
+            output.write(f'{separator}{json.dumps(section_name)}: {json.dumps(dict(properties))}')
+            separator = ', '
+        output.write('}\n')
+
+    else:
+        raise Exception(f'Unknown output format {output_format}')
+
+#
+# Structural diff of sht4 files. Each section's raw chunks are run through a
+# digest as they're stepped over, without decoding any properties; only
+# sections whose digests differ are then loaded and compared property by
+# property.
+#
+
+DIFF_COMPARE_CHUNK_SIZE = 1 << 20
+
+def iter_section_spans(buffer, start=0, header_check=SHT4_HEADER):
+    # Yields (section_name, offset, length, property_count) for each section
+    # chunk of the Properties data in buffer[start:], in file order, stepping
+    # over the chunks without decoding anything. offset is that of the section
+    # chunk itself, and length runs up to the next section chunk (or the end),
+    # so the span can be parsed on its own. A repeated section is yielded once
+    # per repeat.
+    reader = BufferReader(buffer, start)
+    try:
+        if header_check is not None:
+            header_tag = reader.read_pascal_string()
+            if header_tag != header_check:
+                raise Exception(f'Expected to read {header_check} but read {header_tag} instead')
+
+        data = reader.buffer
+        pos = reader.pos
+        end = len(data)
+
+        section_name = None
+        section_start = None
+        property_count = 0
+
+        while pos < end:
+            chunk = data[pos]
+
+            if chunk == Properties.CHUNK_SECTION:
+                if section_name is not None:
+                    yield section_name, section_start, pos - section_start, property_count
+
+                if pos + 1 >= end:
+                    raise Exception(f'Unexpected end of file reading section name at offset {pos}')
+
+                section_start = pos
+                pos += 2 + data[pos + 1]
+                section_name = bytes(data[section_start + 2:pos]).decode('ascii')
+                property_count = 0
+                profile_count('sections_read')
+
+            elif chunk == Properties.CHUNK_VARIABLE:
+                if section_name is None:
+                    raise Exception('Found a property before any section')
+
+                # skip the name and value pascal strings
+                pos += 1
+                if pos < end:
+                    pos += 1 + data[pos]
+                if pos < end:
+                    pos += 1 + data[pos]
+                property_count += 1
+
+            else:
+                pos += 1
+
+        if section_name is not None:
+            yield section_name, section_start, end - section_start, property_count
+    finally:
+        reader.release()
+
+def section_digests(buffer, start=0, header_check=SHT4_HEADER):
+    # Returns an OrderedDict of section_name => digest (bytes) for the
+    # Properties data in buffer[start:], in file order. All the chunks of a
+    # repeated section go into one digest.
+    import hashlib
+
+    digests = OrderedDict()
+
+    with memoryview(buffer) as data:
+        for section_name, offset, length, property_count in iter_section_spans(data, start, header_check):
+            digest = digests.get(section_name)
+            if digest is None:
+                digest = digests[section_name] = hashlib.blake2b(digest_size=16)
+            digest.update(data[offset:offset + length])
+
+    return OrderedDict((section_name, digest.digest()) for section_name, digest in digests.items())
+
+def _buffers_equal(a_buffer, a_start, b_buffer, b_start):
+    if len(a_buffer) - a_start != len(b_buffer) - b_start:
+        return False
+
+    for offset in range(0, len(a_buffer) - a_start, DIFF_COMPARE_CHUNK_SIZE):
+        if a_buffer[a_start + offset:a_start + offset + DIFF_COMPARE_CHUNK_SIZE] != b_buffer[b_start + offset:b_start + offset + DIFF_COMPARE_CHUNK_SIZE]:
+            return False
+
+    return True
+
+def diff_properties(a_section, b_section):
+    # [(property_name, a_value, b_value), ...] for properties that differ,
+    # with None standing in for a missing property
+    changes = []
+
+    for property_name, a_value in a_section.items():
+        b_value = b_section.get(property_name)
+        if a_value != b_value:
+            changes.append((property_name, a_value, b_value))
+
+    for property_name, b_value in b_section.items():
+        if property_name not in a_section:
+            changes.append((property_name, None, b_value))
+
+    return changes
+
+def diff_sht4(a_fobj, b_fobj):
+    # Returns [(section_name, status, property_changes), ...] for the
+    # sections that differ between two sht4 files: a's sections in file
+    # order, then those only b has. status is 'removed' (only in a), 'added'
+    # (only in b) or 'changed'; property_changes is diff_properties' result
+    # for changed sections (empty if only the property order differs), and
+    # empty otherwise.
+    a_buffer, a_start = map_fobj(a_fobj)
+    b_buffer, b_start = map_fobj(b_fobj)
+
+    if _buffers_equal(a_buffer, a_start, b_buffer, b_start):
+        return []
+
+    with profile_stage('diff.digest'):
+        a_digests = section_digests(a_buffer, a_start)
+        b_digests = section_digests(b_buffer, b_start)
+
+    changed_names = {section_name for section_name, digest in a_digests.items() if b_digests.get(section_name, digest) != digest}
+    profile_count('sections_changed', len(changed_names))
+
+    if changed_names:
+        with profile_stage('diff.properties'):
+            a_props = Properties.load_from_buffer(a_buffer, a_start, SHT4_HEADER, changed_names.__contains__)
+            b_props = Properties.load_from_buffer(b_buffer, b_start, SHT4_HEADER, changed_names.__contains__)
+
+    differences = []
+
+    for section_name in a_digests:
+        if section_name not in b_digests:
+            differences.append((section_name, 'removed', []))
+        elif section_name in changed_names:
+            differences.append((section_name, 'changed', diff_properties(a_props._sections[section_name], b_props._sections[section_name])))
+
+    for section_name in b_digests:
+        if section_name not in a_digests:
+            differences.append((section_name, 'added', []))
+
+    return differences
+
+def diff_sht4_files(a_filename, b_filename):
+    with open(a_filename, 'rb') as a_fobj, open(b_filename, 'rb') as b_fobj:
+        return diff_sht4(a_fobj, b_fobj)
+
+def _diff_tree_one(relative_name, a_filename, b_filename):
+    try:
+        differences = diff_sht4_files(a_filename, b_filename)
+        return (relative_name, 'changed' if differences else 'same', differences)
+    except Exception as e:
+        return (relative_name, 'failed', f'{type(e).__name__}: {e}')
+
+def diff_sht4_trees(a_dir, b_dir, pattern='*.sht4', jobs=None):
+    # Returns [(relative_name, status, detail), ...], sorted by name, for
+    # every file matching pattern under either directory. status is 'same',
+    # 'changed' (detail is diff_sht4's result), 'removed' or 'added' (only
+    # under a_dir or b_dir), or 'failed' (detail is the error).
+    from concurrent.futures import ProcessPoolExecutor
+
+    a_files = {relative_name: input_filename for input_filename, relative_name in find_batch_inputs([a_dir], pattern)}
+    b_files = {relative_name: input_filename for input_filename, relative_name in find_batch_inputs([b_dir], pattern)}
+
+    results = [(relative_name, 'removed', None) for relative_name in a_files if relative_name not in b_files]
+    results.extend((relative_name, 'added', None) for relative_name in b_files if relative_name not in a_files)
+
+    common_names = [relative_name for relative_name in a_files if relative_name in b_files]
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results.extend(executor.map(_diff_tree_one, common_names,
+                                    [a_files[relative_name] for relative_name in common_names],
+                                    [b_files[relative_name] for relative_name in common_names],
+                                    chunksize=16))
+
+    results.sort(key=lambda result: result[0])
+
+    return results
+
+def format_sht4_differences(differences, brief=False, indent=''):
+    # Lines describing diff_sht4's result
+    lines = []
+
+    for section_name, status, property_changes in differences:
+        lines.append(f'{indent}{status} section {section_name}')
+        if brief:
+            continue
+
+        if status == 'changed' and not property_changes:
+            lines.append(f'{indent}  (same properties in a different order)')
+
+        for property_name, a_value, b_value in property_changes:
+            if a_value is None:
+                lines.append(f'{indent}  + {property_name}: {b_value!r}')
+            elif b_value is None:
+                lines.append(f'{indent}  - {property_name}: {a_value!r}')
+            else:
+                lines.append(f'{indent}  ~ {property_name}: {a_value!r} -> {b_value!r}')
+
+    return lines
+
+#
+# Section index. One pass over an sht4 file (iter_section_spans, so nothing
+# is decoded) records where each section's chunks are; after that, a section
+# is read by parsing just those bytes out of a memory map, however big the
+# rest of the file is. The index is kept in a sidecar file next to the sht4
+# file and is rebuilt when the file's size or mtime no longer match it.
+#
+
+SECTION_INDEX_SUFFIX = '.index'
+SECTION_INDEX_VERSION = 1
+
+class SectionIndex(Mapping):
+    # section_name => tuple of (offset, length, property_count), one per
+    # time the section appears in the file (almost always just one). size and
+    # mtime_ns are those of the file the index was built from.
+
+    def __init__(self, spans=(), size=None, mtime_ns=None):
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+        sections = OrderedDict()
+        for section_name, offset, length, property_count in spans:
+            sections.setdefault(sys.intern(section_name), []).append((offset, length, property_count))
+
+        self._sections = OrderedDict((section_name, tuple(section_spans)) for section_name, section_spans in sections.items())
+
+    def __len__(self):
+        return len(self._sections)
+
+    def __iter__(self):
+        return iter(self._sections)
+
+    def __getitem__(self, section_name):
+        return self._sections[section_name]
+
+    def spans(self):
+        # (section_name, offset, length, property_count) in file order
+        return sorted(((section_name,) + span for section_name, section_spans in self._sections.items() for span in section_spans), key=lambda span: span[1])
+
+    def property_count(self, section_name):
+        return sum(property_count for offset, length, property_count in self._sections[section_name])
+
+    def matches(self, stat):
+        return self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+    @classmethod
+    def build(cls, buffer, start=0, stat=None, header_check=SHT4_HEADER):
+        with profile_stage('index.build'):
+            spans = list(iter_section_spans(buffer, start, header_check))
+
+        return cls(spans, stat and stat.st_size, stat and stat.st_mtime_ns)
+
+    @classmethod
+    def load(cls, filename, stat=None):
+        # Returns the index from filename's sidecar, or None if there isn't
+        # one or filename has changed since it was written (stat is
+        # filename's, if the caller already has it)
+        import json
+
+        try:
+            with open(filename + SECTION_INDEX_SUFFIX) as fobj:
+                saved = json.load(fobj)
+            if stat is None:
+                stat = os.stat(filename)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if (not isinstance(saved, dict)
+                or saved.get('version') != SECTION_INDEX_VERSION
+                or saved.get('size') != stat.st_size
+                or saved.get('mtime_ns') != stat.st_mtime_ns):
+            return None
+
+        return cls((tuple(span) for span in saved['sections']), stat.st_size, stat.st_mtime_ns)
+
+    def save(self, filename):
+        import json
+
+        saved = {
+            'version': SECTION_INDEX_VERSION,
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'sections': self.spans(),
+        }
+
+        index_filename = filename + SECTION_INDEX_SUFFIX
+        temp_filename = f'{index_filename}.{os.getpid()}.tmp'
+        try:
+            with open(temp_filename, 'w') as fobj:
+                json.dump(saved, fobj, separators=(',', ':'))
+            os.replace(temp_filename, index_filename)
+        except BaseException:
+            try:
+                os.unlink(temp_filename)
+            except FileNotFoundError:
+                pass
+            raise
+
+class IndexedProperties(Mapping):
+    # Read-only view of an sht4 file as section_name => PropertySection,
+    # where a section is parsed out of a memory map of the file only when
+    # it's looked up (and isn't kept). The index comes from the sidecar if
+    # it's current; otherwise it's built, and the sidecar (re)written unless
+    # use_sidecar is False or the directory isn't writable. Close it, or use
+    # it as a context manager, to unmap the file.
+
+    def __init__(self, filename, use_sidecar=True):
+        with open(filename, 'rb') as fobj:
+            stat = os.fstat(fobj.fileno())
+            self._buffer, start = map_fobj(fobj)
+
+        index = SectionIndex.load(filename, stat) if use_sidecar else None
+
+        if index is None:
+            index = SectionIndex.build(self._buffer, start, stat)
+
+            if use_sidecar:
+                try:
+                    index.save(filename)
+                except OSError:
+                    pass
+
+        self.index = index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, section_name):
+        section = None
+
+        with memoryview(self._buffer) as data:
+            for offset, length, property_count in self.index[section_name]:
+                with data[offset:offset + length] as span:
+                    reader = BufferReader(span)
+                    try:
+                        for span_section_name, properties in Properties._iter_sections_from_reader(reader):
+                            if span_section_name != section_name:
+                                raise Exception(f'Index is out of date: expected section {section_name} at offset {offset} but found {span_section_name}')
+                    finally:
+                        reader.release()
+
+                if section is None:
+                    section = properties
+                else:
+                    # repeated section; merge like Properties.load_from_fobj
+                    for property_name, property_value in properties.items_bytes():
+                        section.setdefault_bytes(property_name, property_value)
+
+        return section
+
+def format_section_index(index):
+    lines = [f'{"offset":>10} {"length":>10} {"properties":>10}  section']
+    for section_name, offset, length, property_count in index.spans():
+        lines.append(f'{offset:>10} {length:>10} {property_count:>10}  {section_name}')
+    return lines
+
+#
+# Song catalog. scan reads the metadata of sht2 and sht4 files (skipping
+# their pattern data) on a process pool and keeps it in a SQLite database,
+# one row per file in songs plus its instruments, patterns and orders. Files
+# whose size and mtime match the catalog are not read again, and files that
+# have disappeared from a scanned directory are dropped. order_count is the
+# number of orders in use (up to the last one that isn't ---), not the
+# number of order slots, which is fixed by the format. Eg.
+#
+#   -- songs with an instrument on MIDI channel 10 (stored 0-based)
+#   SELECT DISTINCT path FROM instruments WHERE channel = 9;
+#   -- songs with 48 row patterns (see the ORDER LIST comment in Song._save_to_fobj)
+#   SELECT DISTINCT path FROM patterns WHERE length = 48;
+#   SELECT path FROM songs WHERE order_count > 200;
+#
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS songs (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    format TEXT,
+    name TEXT,
+    author TEXT,
+    tempo INTEGER,
+    speed INTEGER,
+    pattern_count INTEGER,
+    order_count INTEGER,
+    instrument_count INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS instruments (
+    path TEXT NOT NULL,
+    instrument_idx INTEGER NOT NULL,
+    name TEXT,
+    track_width INTEGER,
+    device INTEGER,
+    bank INTEGER,
+    patch INTEGER,
+    channel INTEGER,
+    pitch_bend_sensitivity INTEGER,
+    default_volume INTEGER,
+    global_volume INTEGER,
+    PRIMARY KEY (path, instrument_idx)
+);
+CREATE TABLE IF NOT EXISTS patterns (
+    path TEXT NOT NULL,
+    pattern_idx INTEGER NOT NULL,
+    length INTEGER,
+    highlight_major INTEGER,
+    highlight_minor INTEGER,
+    PRIMARY KEY (path, pattern_idx)
+);
+CREATE TABLE IF NOT EXISTS orders (
+    path TEXT NOT NULL,
+    order_idx INTEGER NOT NULL,
+    pattern_idx INTEGER,
+    PRIMARY KEY (path, order_idx)
+);
+CREATE INDEX IF NOT EXISTS songs_order_count ON songs (order_count);
+CREATE INDEX IF NOT EXISTS instruments_name ON instruments (name);
+CREATE INDEX IF NOT EXISTS instruments_channel ON instruments (channel);
+CREATE INDEX IF NOT EXISTS instruments_patch ON instruments (bank, patch);
+CREATE INDEX IF NOT EXISTS patterns_length ON patterns (length);
+CREATE INDEX IF NOT EXISTS orders_pattern_idx ON orders (pattern_idx);
+'''
+
+CATALOG_TABLES = ('songs', 'instruments', 'patterns', 'orders')
+# Bump this whenever what's stored changes; older catalogs are emptied and
+# rebuilt on the next scan.
+CATALOG_VERSION = 2
+SCAN_PATTERNS = ('*.sht', '*.sht4')
+
+class PrefixedReader:
+    # Reads prefix, then the rest of fobj; for putting bytes that have been
+    # read from a stream that can't seek back in front of it
+
+    def __init__(self, prefix, fobj):
+        self.prefix = prefix
+        self.fobj = fobj
+
+    def read(self, size=-1):
+        prefix = self.prefix
+        if not prefix:
+            return self.fobj.read(size)
+
+        if size is None or size < 0:
+            self.prefix = b''
+            return prefix + self.fobj.read()
+
+        self.prefix = prefix[size:]
+        if len(prefix) >= size:
+            return prefix[:size]
+        return prefix + self.fobj.read(size - len(prefix))
+
+def load_song(fobj, storage='rows', patterns=True):
+    # Returns (format, song) for an sht2 or sht4 file; see
+    # Song.load_from_sht2/load_from_sht4 for storage and patterns
+    signature = b''
+    while len(signature) < 9:
+        # (a pipe may hand over less than was asked for)
+        data = fobj.read(9 - len(signature))
+        if not data:
+            break
+        signature += data
+
+    if fobj.seekable():
+        fobj.seek(-len(signature), os.SEEK_CUR)
+    else:
+        fobj = PrefixedReader(signature, fobj)
+
+    if signature == b'SHKT-SONG':
+        return 'sht2', Song.load_from_sht2(fobj, storage, patterns=patterns)
+
+    return 'sht4', Song.load_from_sht4(fobj, storage, patterns=patterns)
+
+def _scan_one(filename, size, mtime_ns):
+    try:
+        with open(filename, 'rb') as fobj:
+            song_format, song = load_song(fobj, patterns=False)
+        return (filename, size, mtime_ns, song_format, song, None)
+    except Exception as e:
+        return (filename, size, mtime_ns, None, None, f'{type(e).__name__}: {e}')
+
+def open_catalog(catalog_filename):
+    import sqlite3
+
+    connection = sqlite3.connect(catalog_filename)
+    connection.executescript(CATALOG_SCHEMA)
+
+    if connection.execute('PRAGMA user_version').fetchone()[0] != CATALOG_VERSION:
+        with connection:
+            for table in CATALOG_TABLES:
+                connection.execute(f'DELETE FROM {table}')
+            connection.execute(f'PRAGMA user_version = {CATALOG_VERSION}')
+
+    return connection
+
+def used_order_count(order_list):
+    # the number of orders up to and including the last one that isn't ---
+    for order_idx in range(len(order_list) - 1, -1, -1):
+        if order_list[order_idx] is not None:
+            return order_idx + 1
+    return 0
+
+def _catalog_delete(connection, paths):
+    for table in CATALOG_TABLES:
+        connection.executemany(f'DELETE FROM {table} WHERE path = ?', ((path,) for path in paths))
+
+def _catalog_upsert(connection, result):
+    path, size, mtime_ns, song_format, song, error = result
+
+    _catalog_delete(connection, [path])
+
+    if song is None:
+        connection.execute('INSERT INTO songs (path, size, mtime_ns, error) VALUES (?, ?, ?, ?)', (path, size, mtime_ns, error))
+        return
+
+    order_count = used_order_count(song.order_list)
+
+    connection.execute('INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)',
+                       (path, size, mtime_ns, song_format, song.name, song.author, song.tempo, song.speed,
+                        len(song.pattern_metrics), order_count, len(song.instruments)))
+    connection.executemany('INSERT INTO instruments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           ((path, instrument_idx) + tuple(instrument) for instrument_idx, instrument in enumerate(song.instruments)))
+    connection.executemany('INSERT INTO patterns VALUES (?, ?, ?, ?, ?)',
+                           ((path, pattern_idx, metrics.length, metrics.highlight_major, metrics.highlight_minor) for pattern_idx, metrics in enumerate(song.pattern_metrics)))
+    connection.executemany('INSERT INTO orders VALUES (?, ?, ?)',
+                           ((path, order_idx, pattern_idx) for order_idx, pattern_idx in enumerate(song.order_list[:order_count])))
+
+def scan_songs(inputs, catalog_filename, jobs=None, patterns=SCAN_PATTERNS):
+    # Brings the catalog up to date with the files (or directories, searched
+    # recursively for patterns) in inputs. Returns a dict of counts:
+    # scanned, unchanged, removed and failed.
+    from concurrent.futures import ProcessPoolExecutor
+
+    found = {}
+    for pattern in patterns:
+        for input_filename, relative_name in find_batch_inputs(inputs, pattern):
+            found[os.path.abspath(input_filename)] = None
+
+    connection = open_catalog(catalog_filename)
+    try:
+        cataloged = dict((path, (size, mtime_ns)) for path, size, mtime_ns in connection.execute('SELECT path, size, mtime_ns FROM songs'))
+
+        tasks = []
+        unchanged_count = 0
+        missing = []
+
+        for path in found:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                missing.append(path)
+                continue
+
+            if cataloged.get(path) == (stat.st_size, stat.st_mtime_ns):
+                unchanged_count += 1
+            else:
+                tasks.append((path, stat.st_size, stat.st_mtime_ns))
+
+        # files that were cataloged under a scanned directory but are gone now
+        # (not ones that are still there but don't match patterns)
+        directories = tuple(os.path.join(os.path.abspath(input_spec), '') for input_spec in inputs if os.path.isdir(input_spec))
+        removed = [path for path in cataloged if path not in found and path.startswith(directories) and not os.path.exists(path)]
+        removed.extend(path for path in missing if path in cataloged)
+
+        failed_count = 0
+
+        with connection:
+            _catalog_delete(connection, removed)
+
+            if tasks:
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    for result in executor.map(_scan_one, *zip(*tasks), chunksize=16):
+                        _catalog_upsert(connection, result)
+                        if result[-1] is not None:
+                            failed_count += 1
+    finally:
+        connection.close()
+
+    return {'scanned': len(tasks), 'unchanged': unchanged_count, 'removed': len(removed), 'failed': failed_count}
+
+#
+# Standard MIDI File export. Every column of every instrument is an event
+# generator that walks the order list on its own; heapq.merge interleaves
+# them (plus the song and instrument setup events) by time, and the merged
+# stream is written as a single format 0 track as it's produced. Memory use
+# therefore doesn't grow with the length of the song.
+#
+# Each row is MIDI_TICKS_PER_ROW ticks, and there are song.speed rows per
+# quarter note. A note plays until the next note or OFF in its column (or
+# the end of the song); its velocity comes from the row's vol, or the
+# instrument's default_volume, scaled from 0-64 (notes at 0 are silent).
+# Controller set/value rows become control changes. Tracker commands aren't
+# exported.
+#
+
+MIDI_TICKS_PER_ROW = 24
+
+# event priorities, for events on the same tick
+MIDI_SETUP = 0
+MIDI_NOTE_OFF = 1
+MIDI_CONTROL = 2
+MIDI_NOTE_ON = 3
+
+def iter_column_cells(columns, column_idx):
+    # Yields (row_idx, sht4_values) for the non-empty cells of one column of
+    # an instrument pattern, in row order, for any pattern storage
+    if isinstance(columns, PatternRuns):
+        columns = PatternRuns(columns.num_rows, columns.columns[column_idx:column_idx + 1])
+    else:
+        columns = columns[column_idx:column_idx + 1]
+
+    for _, row_idx, values in iter_nonempty_cells(columns):
+        yield row_idx, values
+
+def midi_orders(song):
+    # Returns ([(pattern_idx, start_row), ...], end_row) for the orders that
+    # are played, end_row being the row just after the last of them
+    orders = []
+    start_row = 0
+
+    for pattern_idx in song.order_list:
+        if pattern_idx is None or pattern_idx >= len(song.pattern_metrics):
+            continue
+
+        orders.append((pattern_idx, start_row))
+        start_row += song.pattern_metrics[pattern_idx].length
+
+    return orders, start_row
+
+def _midi_velocity(volume):
+    return min(volume * 2, 127)
+
+def _midi_song_events(song):
+    yield (0, MIDI_SETUP, b'\xff\x51\x03' + (60000000 // max(song.tempo, 1)).to_bytes(3, 'big'))
+
+    name = song.name.encode('ascii', 'replace')[:127]
+    if name:
+        yield (0, MIDI_SETUP, b'\xff\x03' + bytes([len(name)]) + name)
+
+def _midi_instrument_events(instrument):
+    channel = instrument.channel & 0xf
+
+    yield (0, MIDI_SETUP, bytes([0xb0 | channel, 0, instrument.bank & 0x7f]))
+    yield (0, MIDI_SETUP, bytes([0xc0 | channel, instrument.patch & 0x7f]))
+    # pitch bend sensitivity through RPN 0
+    yield (0, MIDI_SETUP, bytes([0xb0 | channel, 101, 0]))
+    yield (0, MIDI_SETUP, bytes([0xb0 | channel, 100, 0]))
+    yield (0, MIDI_SETUP, bytes([0xb0 | channel, 6, instrument.pitch_bend_sensitivity & 0x7f]))
+    # then the null RPN, so nothing later changes the pitch bend range
+    yield (0, MIDI_SETUP, bytes([0xb0 | channel, 101, 127]))
+    yield (0, MIDI_SETUP, bytes([0xb0 | channel, 100, 127]))
+    yield (0, MIDI_SETUP, bytes([0xb0 | channel, 7, instrument.global_volume & 0x7f]))
+
+def _midi_column_events(song, orders, end_row, instrument_idx, column_idx):
+    instrument = song.instruments[instrument_idx]
+    channel = instrument.channel & 0xf
+    instrument_patterns = song.rows[instrument_idx]
+    playing = None
+
+    for pattern_idx, start_row in orders:
+        for row_idx, (note, vol, command, parameter, controller_set, controller_value) in iter_column_cells(instrument_patterns[pattern_idx], column_idx):
+            tick = (start_row + row_idx) * MIDI_TICKS_PER_ROW
+
+            if note != CELL_NOTE_CLEAR and playing is not None:
+                yield (tick, MIDI_NOTE_OFF, bytes([0x80 | channel, playing, 0]))
+                playing = None
+
+            if controller_set != CELL_CONTROLLER_SET_CLEAR:
+                yield (tick, MIDI_CONTROL, bytes([0xb0 | channel, controller_set & 0x7f, controller_value & 0x7f]))
+
+            if note < 128:
+                velocity = _midi_velocity(instrument.default_volume if vol == CELL_VOL_CLEAR else vol)
+                if velocity:
+                    # (a velocity 0 note on would be a note off)
+                    yield (tick, MIDI_NOTE_ON, bytes([0x90 | channel, note, velocity]))
+                    playing = note
+
+    if playing is not None:
+        yield (end_row * MIDI_TICKS_PER_ROW, MIDI_NOTE_OFF, bytes([0x80 | channel, playing, 0]))
+
+def iter_midi_events(song):
+    # Yields (tick, priority, message) for the whole song in time order
+    import heapq
+
+    orders, end_row = midi_orders(song)
+
+    streams = [_midi_song_events(song)]
+    streams.extend(_midi_instrument_events(instrument) for instrument in song.instruments)
+    for instrument_idx, instrument in enumerate(song.instruments):
+        streams.extend(_midi_column_events(song, orders, end_row, instrument_idx, column_idx) for column_idx in range(instrument.track_width))
+
+    yield from heapq.merge(*streams, key=lambda event: (event[0], event[1]))
+    yield (end_row * MIDI_TICKS_PER_ROW, MIDI_SETUP, b'\xff\x2f\x00')
+
+def _midi_variable_length(value):
+    encoded = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        encoded.append(0x80 | (value & 0x7f))
+        value >>= 7
+    encoded.reverse()
+    return bytes(encoded)
+
+def write_midi(song, fobj):
+    # Writes song as a format 0 Standard MIDI File. The track length is
+    # filled in afterwards if fobj can seek; otherwise the track is
+    # collected in memory first.
+    fobj.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, max(song.speed, 1) * MIDI_TICKS_PER_ROW))
+
+    if not fobj.seekable():
+        track = BytesIO()
+        _write_midi_track(song, track)
+        fobj.write(b'MTrk' + struct.pack('>I', track.tell()) + track.getbuffer())
+        return
+
+    fobj.write(b'MTrk\0\0\0\0')
+    track_start = fobj.tell()
+    _write_midi_track(song, fobj)
+    track_end = fobj.tell()
+
+    fobj.seek(track_start - 4)
+    fobj.write(struct.pack('>I', track_end - track_start))
+    fobj.seek(track_end)
+
+def _write_midi_track(song, fobj):
+    delta_encodings = {}
+    last_tick = 0
+    running_status = None
+    event_count = 0
+
+    for tick, priority, message in iter_midi_events(song):
+        delta = tick - last_tick
+        last_tick = tick
+
+        delta_encoding = delta_encodings.get(delta)
+        if delta_encoding is None:
+            delta_encoding = delta_encodings[delta] = _midi_variable_length(delta)
+
+        if message[0] == running_status:
+            fobj.write(delta_encoding + message[1:])
+        else:
+            fobj.write(delta_encoding + message)
+            running_status = message[0] if message[0] < 0xf0 else None
+
+        event_count += 1
+
+    profile_count('midi_events_written', event_count)
+
+def export_midi(input_filename, output_filename, overwrite_ok=False, storage='runs'):
+    # Writes a Standard MIDI File for an sht2 or sht4 file. Either filename
+    # may be STDIO_FILENAME.
+    if _output_exists(output_filename) and not overwrite_ok:
+        return False
+
+    with open_input(input_filename) as fobj:
+        with profile_stage('load'):
+            song_format, song = load_song(fobj, storage)
+
+    with profile_stage('write_midi'):
+        with open_output(output_filename) as fobj:
+            write_midi(song, fobj)
+
+    return True
+
+#
+# Conversion server. Listens on a unix socket for newline-delimited JSON
+# requests (one JSON response line each) and runs them on a pool of worker
+# processes that are started up front, so requests don't pay for interpreter
+# startup. Requests:
+#
+#   {"op": "convert", "input": "in.sht", "output": "out.sht4", "overwrite": false}
+#   {"op": "convert", "input_data": "<base64 sht2>"}   => {"output_data": "<base64 sht4>"}
+#   {"op": "show", "input": "in.sht4" or "input_data": ..., "format": "ndjson", "section": ["GLOB"], "sort": false}
+#   {"op": "stats"}
+#   {"op": "ping"}
+#
+# Every response has "ok" (and "error" when it's false). At most max_pending
+# convert/show requests are queued or running at once; beyond that, requests
+# are refused with "busy" straight away rather than piling up.
+#
+
+SERVER_MAX_LINE = 256 << 20
+SERVER_LATENCY_SAMPLES = 1000
+
+def _serve_ping():
+    return os.getpid()
+
+def _serve_convert(request):
+    import base64
+
+    if 'input_data' in request:
+        output = BytesIO()
+        convert2to4_fobj(BytesIO(base64.b64decode(request['input_data'])), output, request.get('storage', 'runs'))
+        return {'output_data': base64.b64encode(output.getvalue()).decode('ascii')}
+
+    incremental = request.get('incremental', False)
+    if not convert2to4(request['input'], request['output'], request.get('overwrite', False) or incremental, request.get('storage', 'runs'), incremental=incremental):
+        raise Exception(f'{request["output"]} already exists')
+
+    return {}
+
+def _serve_show(request):
+    import base64
+    from io import StringIO
+
+    output = StringIO()
+    show_args = (request.get('format', 'ndjson'), request.get('section'), request.get('sort', False), output)
+
+    if 'input_data' in request:
+        show4_fobj(BytesIO(base64.b64decode(request['input_data'])), *show_args)
+    else:
+        show4(request['input'], *show_args)
+
+    return {'output': output.getvalue()}
+
+class ConversionServer:
+    WORKER_OPS = {
+        'convert': _serve_convert,
+        'show': _serve_show,
+    }
+
+    def __init__(self, socket_path, jobs=None, max_pending=64):
+        self.socket_path = socket_path
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_pending = max_pending
+
+        self.pending = 0
+        self.refused = 0
+        self.latencies = {} # op => deque of recent latencies in seconds
+        self.counts = {} # op => [succeeded, failed]
+
+    def run(self):
+        import asyncio
+
+        asyncio.run(self._run())
+
+    async def _run(self):
+        import asyncio
+        import signal
+        from concurrent.futures import ProcessPoolExecutor
+
+        self._remove_stale_socket()
+
+        loop = asyncio.get_running_loop()
+
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            self.executor = executor
+
+            # start every worker now, not on the first requests
+            await asyncio.gather(*(loop.run_in_executor(executor, _serve_ping) for worker_idx in range(self.jobs)))
+
+            server = await asyncio.start_unix_server(self._handle_connection, self.socket_path, limit=SERVER_MAX_LINE)
+            print(f'listening on {self.socket_path} with {self.jobs} workers', file=sys.stderr, flush=True)
+
+            stop = asyncio.Event()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, stop.set)
+
+            try:
+                async with server:
+                    await stop.wait()
+            finally:
+                try:
+                    os.unlink(self.socket_path)
+                except FileNotFoundError:
+                    pass
+
+    def _remove_stale_socket(self):
+        import socket
+
+        if not os.path.exists(self.socket_path):
+            return
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                os.unlink(self.socket_path)
+                return
+
+        raise Exception(f'A server is already listening on {self.socket_path}')
+
+    async def _handle_connection(self, reader, writer):
+        import asyncio
+        import json
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    # longer than SERVER_MAX_LINE; the rest of the line is
+                    # still unread, so this connection can't go on
+                    writer.write(json.dumps({'ok': False, 'error': f'Request is longer than {SERVER_MAX_LINE} bytes'}).encode('utf-8') + b'\n')
+                    await writer.drain()
+                    break
+
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line)
+                    response = await self._dispatch(request)
+                except Exception as e:
+                    response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request):
+        import asyncio
+
+        op = request.get('op')
+
+        if op == 'ping':
+            return {'ok': True}
+        elif op == 'stats':
+            return dict(self.stats(), ok=True)
+        elif op not in ConversionServer.WORKER_OPS:
+            raise Exception(f'Unknown op {op}')
+
+        if self.pending >= self.max_pending:
+            self.refused += 1
+            return {'ok': False, 'error': 'busy'}
+
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, ConversionServer.WORKER_OPS[op], request)
+            result['ok'] = True
+        except Exception as e:
+            result = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        finally:
+            self.pending -= 1
+
+        self._record(op, time.perf_counter() - start, result['ok'])
+        return result
+
+    def _record(self, op, latency, ok):
+        from collections import deque
+
+        self.latencies.setdefault(op, deque(maxlen=SERVER_LATENCY_SAMPLES)).append(latency)
+        self.counts.setdefault(op, [0, 0])[0 if ok else 1] += 1
+
+    def stats(self):
+        ops = {}
+
+        for op, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            succeeded, failed = self.counts[op]
+            ops[op] = {
+                'succeeded': succeeded,
+                'failed': failed,
+                'latency_mean': sum(ordered) / len(ordered),
+                'latency_p50': ordered[len(ordered) // 2],
+                'latency_p95': ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)],
+                'latency_max': ordered[-1],
+            }
+
+        return {'workers': self.jobs, 'pending': self.pending, 'max_pending': self.max_pending, 'refused': self.refused, 'ops': ops}
+
+def request_server(socket_path, request):
+    # Client side: sends one request to a ConversionServer and returns its
+    # response
+    import json
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+        with sock.makefile('rb') as fobj:
+            return json.loads(fobj.readline())
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache', action='store_true', default=False, help='Reuse results of earlier conversions of identical input files')
+    parser.add_argument('--cache-dir', default=None, help='Cache directory; implies --cache (default: %s)' % ConversionCache.default_directory())
+    parser.add_argument('--cache-max-size', type=parse_size, default=None, help='Evict least recently used entries beyond this size, eg. 500M (default: 1G)')
+    parser.add_argument('--cache-link', action='store_true', default=False, help='Hardlink outputs to cache entries instead of copying (outputs must not be modified in place)')
+
+def cache_from_arguments(args):
+    if not (args.cache or args.cache_dir):
+        return None
+
+    return ConversionCache(args.cache_dir, args.cache_max_size, args.cache_link)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help='Convert Shaketracker 0.2.x (or 0.3.x?) file to 0.4.x format')
+    convert_parser.add_argument('input_filename', help='Shaketracker 0.2.x file to be converted, or - for stdin')
+    convert_parser.add_argument('output_filename', help='Filename for Shaketracker 0.4.x output, or - for stdout')
+    convert_parser.add_argument('--overwrite', help='Overwrite output file if it already exists', action='store_true', default=False)
+    convert_parser.add_argument('--storage', choices=PATTERN_STORAGES, default='runs', help='How pattern data is held during conversion (default: %(default)s); columnar requires numpy')
+    convert_parser.add_argument('--columnar', help='Same as --storage columnar', action='store_const', dest='storage', const='columnar')
+    convert_parser.add_argument('--incremental', action='store_true', default=False, help='Reuse unchanged patterns from the previous incremental conversion to the output file (implies --overwrite)')
+    convert_parser.add_argument('--profile', metavar='OUT_JSON', help='Write per-stage timings and counters to OUT_JSON')
+    add_cache_arguments(convert_parser)
+
+    convert2_parser = subparsers.add_parser('convert-to-sht2', help='Convert Shaketracker 0.4.x file to 0.2.x format (or re-encode a 0.2.x file compactly)')
+    convert2_parser.add_argument('input_filename', help='Shaketracker 0.4.x (or 0.2.x) file to be converted, or - for stdin')
+    convert2_parser.add_argument('output_filename', help='Filename for Shaketracker 0.2.x output, or - for stdout')
+    convert2_parser.add_argument('--overwrite', help='Overwrite output file if it already exists', action='store_true', default=False)
+    convert2_parser.add_argument('--storage', choices=PATTERN_STORAGES, default='runs', help='How pattern data is held during conversion (default: %(default)s); columnar requires numpy')
+    convert2_parser.add_argument('--verify', action='store_true', default=False, help='Read the output back in and check that it decodes to the same song')
+    convert2_parser.add_argument('--profile', metavar='OUT_JSON', help='Write per-stage timings and counters to OUT_JSON')
+
+    batch_parser = subparsers.add_parser('convert-batch', help='Convert many Shaketracker 0.2.x files in parallel')
+    batch_parser.add_argument('inputs', nargs='+', help='Input files, globs, or directories (searched recursively)')
+    batch_parser.add_argument('--output-dir', required=True, help='Directory for Shaketracker 0.4.x output; directory layout of inputs is preserved')
+    batch_parser.add_argument('--pattern', default='*.sht', help='Filename pattern to match when searching directories (default: %(default)s)')
+    batch_parser.add_argument('--extension', default='.sht4', help='Extension for output files (default: %(default)s)')
+    batch_parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    batch_parser.add_argument('--overwrite', help='Overwrite output files if they already exist', action='store_true', default=False)
+    batch_parser.add_argument('--storage', choices=PATTERN_STORAGES, default='runs', help='How pattern data is held during conversion (default: %(default)s); columnar requires numpy')
+    batch_parser.add_argument('--columnar', help='Same as --storage columnar', action='store_const', dest='storage', const='columnar')
+    batch_parser.add_argument('--incremental', action='store_true', default=False, help='Reuse unchanged patterns from previous incremental conversions to the output files (implies --overwrite)')
+    add_cache_arguments(batch_parser)
+
+    serve_parser = subparsers.add_parser('serve', help='Run a conversion server on a unix socket')
+    serve_parser.add_argument('--socket', required=True, help='Path of the unix socket to listen on')
+    serve_parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    serve_parser.add_argument('--max-pending', type=int, default=64, help='Refuse convert/show requests beyond this many queued or running (default: %(default)s)')
+
+    request_parser = subparsers.add_parser('request', help='Send one request to a conversion server and print its response')
+    request_parser.add_argument('request', help='JSON request, eg. \'{"op": "stats"}\' (see ConversionServer)')
+    request_parser.add_argument('--socket', required=True, help='Path of the server\'s unix socket')
+
+    cache_parser = subparsers.add_parser('cache', help='Inspect or prune the conversion cache')
+    cache_parser.add_argument('cache_command', choices=('stats', 'prune'))
+    cache_parser.add_argument('--cache-dir', default=None, help='Cache directory (default: %s)' % ConversionCache.default_directory())
+    cache_parser.add_argument('--max-size', type=parse_size, default=None, help='Prune down to this size, eg. 500M (default: 1G)')
+
+    diff_parser = subparsers.add_parser('diff', help='Compare two Shaketracker 0.4.x files, or two directories of them, section by section')
+    diff_parser.add_argument('a', help='File or directory to compare from')
+    diff_parser.add_argument('b', help='File or directory to compare to')
+    diff_parser.add_argument('--pattern', default='*.sht4', help='Filename pattern to match when comparing directories (default: %(default)s)')
+    diff_parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of worker processes for directories (default: number of CPUs)')
+    diff_parser.add_argument('--brief', action='store_true', default=False, help='Only list differing files and sections, not property values')
+    diff_parser.add_argument('--profile', metavar='OUT_JSON', help='Write per-stage timings and counters to OUT_JSON')
+
+    midi_parser = subparsers.add_parser('export-midi', help='Export a Shaketracker 0.2.x or 0.4.x file as a Standard MIDI File')
+    midi_parser.add_argument('input_filename', help='Shaketracker file to export, or - for stdin')
+    midi_parser.add_argument('output_filename', help='Filename for the MIDI output, or - for stdout')
+    midi_parser.add_argument('--overwrite', help='Overwrite output file if it already exists', action='store_true', default=False)
+    midi_parser.add_argument('--storage', choices=PATTERN_STORAGES, default='runs', help='How pattern data is held during export (default: %(default)s); columnar requires numpy')
+    midi_parser.add_argument('--profile', metavar='OUT_JSON', help='Write per-stage timings and counters to OUT_JSON')
+
+    scan_parser = subparsers.add_parser('scan', help='Record metadata of Shaketracker files in a SQLite catalog')
+    scan_parser.add_argument('inputs', nargs='+', help='Input files, globs, or directories (searched recursively)')
+    scan_parser.add_argument('--catalog', required=True, help='SQLite database to create or update')
+    scan_parser.add_argument('--pattern', action='append', default=None, help='Filename pattern to match when searching directories (may be repeated; default: %s)' % ' '.join(SCAN_PATTERNS))
+    scan_parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+
+    index_parser = subparsers.add_parser('index', help='Index the sections of a Shaketracker 0.4.x file, and read sections through the index')
+    index_parser.add_argument('input_filename', help='Shaketracker 0.4.x file to index')
+    index_parser.add_argument('--section', action='append', metavar='GLOB', help='Show sections whose name matches GLOB (may be repeated) instead of listing the index')
+    index_parser.add_argument('--format', choices=('pprint', 'json', 'ndjson'), default='ndjson', help='Output format for --section (default: %(default)s)')
+    index_parser.add_argument('--no-sidecar', dest='sidecar', action='store_false', default=True, help='Neither read nor write the %s sidecar file; always scan the file' % SECTION_INDEX_SUFFIX)
+    index_parser.add_argument('--profile', metavar='OUT_JSON', help='Write per-stage timings and counters to OUT_JSON')
+
+    show4_parser = subparsers.add_parser('show', help='Read a Shaketracker 0.4.x file and display its contents')
+    show4_parser.add_argument('input_filename', help='Shaketracker 0.4.x file to read')
+    show4_parser.add_argument('--format', choices=('pprint', 'json', 'ndjson'), default='pprint', help='Output format (default: %(default)s); json and ndjson are streamed as the file is read')
+    show4_parser.add_argument('--section', action='append', metavar='GLOB', help='Only show sections whose name matches GLOB (may be repeated)')
+    show4_parser.add_argument('--sort', action='store_true', default=False, help='Sort sections and properties by name for json/ndjson output (pprint output is always sorted)')
+    show4_parser.add_argument('--profile', metavar='OUT_JSON', help='Write per-stage timings and counters to OUT_JSON')
+
+    args = parser.parse_args()
+
+    # the profile is saved however the command ends, including SystemExit
+    profile = Profile() if getattr(args, 'profile', None) else None
+
+    with (profiling(profile) if profile is not None else nullcontext()):
+        try:
+            if args.command == 'convert':
+                cache = cache_from_arguments(args)
+
+                if _is_stdio(args.input_filename, args.output_filename) and (cache is not None or args.incremental):
+                    parser.error('--cache and --incremental need real input and output files, not -')
+
+                with profile_stage('convert'):
+                    converted = convert2to4(args.input_filename, args.output_filename, args.overwrite or args.incremental, args.storage, cache, args.incremental)
+
+                # a hit leaves the cache as it was, so only a miss pays for
+                # walking it
+                if cache is not None and cache.stored:
+                    cache.prune()
+
+                if not converted:
+                    print(f'{args.output_filename} already exists; refusing to overwrite. Pass --overwrite if you want to do it anyway.', file=sys.stderr)
+                    raise SystemExit(1)
+            elif args.command == 'convert-to-sht2':
+                with profile_stage('convert'):
+                    converted = convert4to2(args.input_filename, args.output_filename, args.overwrite, args.storage, args.verify)
+
+                if not converted:
+                    print(f'{args.output_filename} already exists; refusing to overwrite. Pass --overwrite if you want to do it anyway.', file=sys.stderr)
+                    raise SystemExit(1)
+            elif args.command == 'convert-batch':
+                results = convert2to4_batch(args.inputs, args.output_dir, args.overwrite or args.incremental, args.jobs, args.pattern, args.extension, args.storage, cache_from_arguments(args), args.incremental)
+
+                counts = {}
+                for input_filename, output_filename, status, message in results:
+                    counts[status] = counts.get(status, 0) + 1
+                    if message is None:
+                        print(f'{status}: {input_filename} -> {output_filename}')
+                    else:
+                        print(f'{status}: {input_filename} -> {output_filename} ({message})')
+
+                print(', '.join(f'{count} {status}' for status, count in sorted(counts.items())) or 'no input files found')
+
+                if counts.get('failed'):
+                    raise SystemExit(1)
+            elif args.command == 'serve':
+                try:
+                    ConversionServer(args.socket, args.jobs, args.max_pending).run()
+                except KeyboardInterrupt:
+                    pass
+            elif args.command == 'request':
+                import json
+
+                response = request_server(args.socket, json.loads(args.request))
+                print(json.dumps(response))
+
+                if not response.get('ok'):
+                    raise SystemExit(1)
+            elif args.command == 'cache':
+                cache = ConversionCache(args.cache_dir)
+
+                if args.cache_command == 'stats':
+                    for name, value in cache.stats().items():
+                        print(f'{name}: {value}')
+                elif args.cache_command == 'prune':
+                    removed_count, removed_size = cache.prune(args.max_size)
+                    print(f'removed {removed_count} entries ({removed_size} bytes)')
+            elif args.command == 'diff':
+                # exits 0 if there are no differences, 1 if there are, 2 on errors
+                if os.path.isdir(args.a) and os.path.isdir(args.b):
+                    with profile_stage('diff'):
+                        results = diff_sht4_trees(args.a, args.b, args.pattern, args.jobs)
+
+                    counts = {}
+                    for relative_name, status, detail in results:
+                        counts[status] = counts.get(status, 0) + 1
+                        if status == 'same':
+                            continue
+                        elif status == 'failed':
+                            print(f'{status}: {relative_name} ({detail})')
+                        else:
+                            print(f'{status}: {relative_name}')
+                            if detail:
+                                print('\n'.join(format_sht4_differences(detail, args.brief, '  ')))
+
+                    print(', '.join(f'{count} {status}' for status, count in sorted(counts.items())) or 'no files found')
+                    exit_status = 2 if counts.get('failed') else 1 if len(results) > counts.get('same', 0) else 0
+                elif os.path.isdir(args.a) or os.path.isdir(args.b):
+                    print('diff needs two files or two directories', file=sys.stderr)
+                    exit_status = 2
+                else:
+                    with profile_stage('diff'):
+                        differences = diff_sht4_files(args.a, args.b)
+
+                    for line in format_sht4_differences(differences, args.brief):
+                        print(line)
+                    exit_status = 1 if differences else 0
+
+                raise SystemExit(exit_status)
+            elif args.command == 'export-midi':
+                with profile_stage('export_midi'):
+                    exported = export_midi(args.input_filename, args.output_filename, args.overwrite, args.storage)
+
+                if not exported:
+                    print(f'{args.output_filename} already exists; refusing to overwrite. Pass --overwrite if you want to do it anyway.', file=sys.stderr)
+                    raise SystemExit(1)
+            elif args.command == 'scan':
+                counts = scan_songs(args.inputs, args.catalog, args.jobs, args.pattern or SCAN_PATTERNS)
+                print(', '.join(f'{count} {status}' for status, count in counts.items()))
+            elif args.command == 'index':
+                with profile_stage('index'), IndexedProperties(args.input_filename, args.sidecar) as indexed:
+                    if args.section:
+                        section_filter = section_glob_filter(args.section)
+                        write_sections(((section_name, indexed[section_name]) for section_name in indexed if section_filter(section_name)), args.format)
+                    else:
+                        for line in format_section_index(indexed.index):
+                            print(line)
+            elif args.command == 'show':
+                with profile_stage('show'):
+                    show4(args.input_filename, args.format, args.section, args.sort)
+        finally:
+            if profile is not None:
+                profile.save(args.profile)
+
+if __name__ == '__main__':
+    main()